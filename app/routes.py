@@ -1,43 +1,148 @@
 import json
+import time
+import redis
+from functools import lru_cache
 from pathlib import Path
+from uuid import uuid4
 from celery import Celery
-from celery.result import AsyncResult
-from flask import Flask, request, jsonify, render_template, redirect, url_for, send_file
+from celery.signals import worker_ready, worker_process_init
+from celery.result import AsyncResult, GroupResult
+from flask import Flask, Response, request, jsonify, render_template, redirect, url_for, send_file
+from prometheus_client import generate_latest, start_http_server, CONTENT_TYPE_LATEST
+from eo.archive import iter_entry
+from eo.config import get_config
 from eo.logger import logger
-from eo.modes.basic import BasicMode
+from eo.job_cache import JobCache, payload_key, evict_outputs
+from eo.progress import JobProgress, ProgressStore
 from eo.dataclasses.payload import validate_payload, InvalidPayloadError, InvalidFrequencyError
 
+# NOTE The web tier only validates payloads and submits tasks, so nothing of the geospatial stack
+#  (rasterio, geopandas, matplotlib, pystac_client...) is imported here. The tasks import the modes
+#  when they run and the worker loads them once per process on start, see warm_worker().
+
 PROJECT_DIR = Path(__file__).resolve().parent.parent
+CONFIG = get_config()
+JOB_CACHE_CONFIG = CONFIG['job_cache']
+PROGRESS_CONFIG = CONFIG['progress']
+
+REDIS_URL = "redis://redis:6379/0" # TODO Add this as a config e.g. if ran in local then "redis://127.0.0.1:6379/0"
 
 app = Flask(__name__)
 celery = Celery(
     __name__,
-    broker="redis://redis:6379/0", # TODO Add this as a config e.g. if ran in local then broker="redis://127.0.0.1:6379/0",
-    backend="redis://redis:6379/0"
+    broker=REDIS_URL,
+    backend=REDIS_URL
 )
+celery.conf.result_expires = JOB_CACHE_CONFIG['ttl'] # Cached jobs point to their task's result
 log = logger(PROJECT_DIR / 'logs/eo.log')
+REDIS = redis.Redis.from_url(REDIS_URL)
+JOB_CACHE = JobCache(REDIS, ttl=JOB_CACHE_CONFIG['ttl'], lock_ttl=JOB_CACHE_CONFIG['lock_ttl'])
+PROGRESS = ProgressStore(REDIS, ttl=JOB_CACHE_CONFIG['ttl']) # Kept as long as the task's result
+
+
+def submit_download(validated, items=None) -> tuple:
+    """Task id of a finished or running job with the same payload, else of a new call_download, and which one it is.
+    `items` are the unsigned items of a search already made for the payload, see call_batch()."""
+    key = payload_key(validated)
+
+    cached = JOB_CACHE.get_result(key)
+    if cached is not None and AsyncResult(cached['task_id']).state == 'SUCCESS':
+        log.info(f"SERVING CACHED RESULT OF TASK {cached['task_id']}")
+        return cached['task_id'], 'cached'
+
+    task_id = str(uuid4())
+    running = JOB_CACHE.claim(key, task_id)
+    if running is not None:
+        log.info(f'JOINING RUNNING TASK {running}')
+        return running, 'running'
+
+    try:
+        call_download.apply_async((validated, items), task_id=task_id)
+    except Exception:
+        JOB_CACHE.release(key, task_id) # Else identical payloads would join a task that never runs
+        raise
+
+    return task_id, 'submitted'
+
+
+def get_task_status(task_id) -> dict:
+    """State, progress and result of a task without waiting for it"""
+    result = AsyncResult(task_id)
+    status = {
+        "task_id": task_id,
+        "state": result.state,
+        "ready": result.ready(),
+        "success": result.successful(),
+        "progress": PROGRESS.get(task_id),
+        "result": result.result if result.successful() else None,
+    }
+    if result.failed():
+        status["error"] = str(result.result)
+
+    return status
+
+
+def server_sent_event(data, event) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
 
 
 @app.route('/')
 def index():
     return '<h1>Hello, World!</h1>'
 
+@app.route('/metrics')
+def metrics():
+    # NOTE Per gunicorn worker, the stage metrics of the jobs are on the Celery worker's metrics_port
+    return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
+
 @app.route('/download/<task_id>', methods=['GET'])
 def download_result(task_id):
     result = AsyncResult(task_id)
-    if result.ready():
-        return send_file(result.get(), as_attachment=True)
+    if result.successful():
+        return send_file(result.result, as_attachment=True)
 
     return render_template('download.html', task_id={"task_id": task_id})
 
+@app.route('/download/<task_id>/<path:name>', methods=['GET'])
+def download_output(task_id, name):
+    """One output of a job, as soon as it is written and even if the job is still running"""
+    progress = PROGRESS.get(task_id) or {}
+    output = next((output for output in progress.get('outputs', []) if output['name'] == name), None)
+    if output is None:
+        return jsonify({"status": "error", "message": f'No output {name} for task {task_id}'}), 404
+
+    if 'archive' in output: # An entry of the job's zip, which may still be open
+        return Response(
+            iter_entry(output['archive'], output['offset'], output['bytes'], output['compress_type']),
+            mimetype='application/octet-stream',
+            headers={'Content-Disposition': f'attachment; filename="{Path(name).name}"'}
+        )
+
+    return send_file(output['path'], as_attachment=True)
+
 @app.route('/status/<task_id>', methods=['GET'])
 def task_status(task_id):
-    result = AsyncResult(task_id)
-    return jsonify({
-        "ready": result.ready(),
-        "success": result.state == 'SUCCESS',
-        "result": result.get()
-    })
+    return jsonify(get_task_status(task_id))
+
+@app.route('/status/<task_id>/stream', methods=['GET'])
+def task_status_stream(task_id):
+    """Server-Sent Events: `progress` on every change of the job's progress, then `status` once it is done"""
+    # NOTE Each stream holds a connection open, so gunicorn runs gevent workers. Streams close after
+    #  stream_timeout and EventSource reconnects by itself.
+    def events():
+        yield f"retry: {int(PROGRESS_CONFIG['heartbeat'] * 1000)}\n\n"
+        for state in PROGRESS.subscribe(task_id, timeout=PROGRESS_CONFIG['stream_timeout'], heartbeat=PROGRESS_CONFIG['heartbeat']):
+            if state is not None:
+                yield server_sent_event(state, 'progress')
+            else:
+                yield ": keepalive\n\n"
+
+            status = get_task_status(task_id)
+            if status['ready']:
+                yield server_sent_event(status, 'status')
+                return
+
+    return Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route("/download", methods=['GET', 'POST'])
 def download():
@@ -49,8 +154,7 @@ def download():
         log.info(f"VALIDATED: {validated}")
 
         log.info('CALLING FROM /download')
-        task = call_download.delay(validated)
-        task_id = task.task_id
+        task_id, _ = submit_download(validated)
         return redirect(url_for('download_result', task_id=task_id))
    
     # TODO Add logger/handling
@@ -65,12 +169,72 @@ def api_download():
         validated = validate_payload(data)
 
         log.info('CALLING FROM /api/download')
-        async_task = call_download.delay(validated)
-        return jsonify({"status": "ok", "received": data, "async_id": async_task.id})
+        task_id, job = submit_download(validated)
+        return jsonify({"status": "ok", "received": data, "async_id": task_id, "job": job})
     
     if data is None:
         return jsonify({"status": "error", "message": 'No data received', "async_id": async_task.id})
 
+@app.route('/api/batch', methods=['POST'])
+def api_batch():
+    data = request.get_json(silent=True)
+    payloads = data.get('payloads') if isinstance(data, dict) else data
+
+    if not payloads:
+        return jsonify({"status": "error", "message": 'No payloads received'}), 400
+    if not isinstance(payloads, list) or not all(isinstance(payload, dict) for payload in payloads):
+        raise InvalidPayloadError(message='Invalid batch: payloads must be a list of objects')
+
+    validated = [validate_payload(payload) for payload in payloads]
+
+    log.info(f'CALLING FROM /api/batch: {len(validated)} PAYLOADS')
+    async_task = call_batch.delay(validated)
+    return jsonify({"status": "ok", "count": len(validated), "batch_id": async_task.id})
+
+@app.route('/api/batch/<batch_id>', methods=['GET'])
+def batch_status(batch_id):
+    result = AsyncResult(batch_id)
+    if not result.ready():
+        return jsonify({"batch_id": batch_id, "ready": False, "stage": "search"})
+    if result.failed():
+        return jsonify({"batch_id": batch_id, "ready": True, "stage": "search", "error": str(result.result)}), 500
+
+    group_result = GroupResult.restore(result.result, app=celery)
+    return jsonify({
+        "batch_id": batch_id,
+        "ready": group_result.ready(),
+        "stage": "process",
+        "completed": group_result.completed_count(),
+        "total": len(group_result.results),
+        "jobs": [
+            {
+                "task_id": job.id,
+                "state": job.state,
+                "progress": PROGRESS.get(job.id),
+                "result": job.result if job.successful() else None
+            }
+            for job in group_result.results
+        ]
+    })
+
+@app.route('/api/zonal', methods=['POST'])
+def api_zonal():
+    data = request.get_json(silent=True)
+
+    if not data:
+        return jsonify({"status": "error", "message": 'No data received'}), 400
+
+    output_format = request.args.get('format', 'json')
+    if output_format not in ('json', 'parquet'):
+        return jsonify({"status": "error", "message": f'Invalid format: {output_format}'}), 400
+
+    log.info(f"PAYLOAD: {data}")
+    validated = validate_payload(data)
+
+    log.info('CALLING FROM /api/zonal')
+    async_task = call_zonal.delay(validated, output_format)
+    return jsonify({"status": "ok", "received": data, "async_id": async_task.id})
+
 @app.errorhandler(InvalidPayloadError)
 @app.errorhandler(InvalidFrequencyError)
 def handle_payload_errors(e):
@@ -80,24 +244,124 @@ def handle_payload_errors(e):
     return response
     
 @celery.task(bind=True)
-def call_download(self, data):
+def call_download(self, data, items=None):
     with app.app_context():
         with app.test_request_context():
             if len(data) > 0:
                 task_id = self.request.id
+                key = payload_key(data)
+                progress = JobProgress(callback=lambda state: PROGRESS.publish(task_id, state))
                 log.info(f"TASK ID: {task_id}")
 
                 try:
-                    basic_mode = BasicMode(data)
-                    out_file = basic_mode.run()
-                    return str(out_file)
+                    with JOB_CACHE.hold(key, task_id):
+                        out_file = get_mode(data, progress, out_dir=get_task_dir(task_id), items=items).run()
+                    JOB_CACHE.finish(key, task_id, out_file)
                 except Exception as e:
+                    JOB_CACHE.release(key, task_id)
+                    progress.fail(e)
                     log.error(f"TASK {task_id}: {AsyncResult(task_id).state}", exc_info=True)
+                    raise
+
+                # Best effort, the job already succeeded
+                try:
+                    evicted = evict_outputs(
+                        CONFIG['processed_images_directory'], JOB_CACHE_CONFIG['ttl'], JOB_CACHE_CONFIG['max_size_mb'] * 1024 ** 2
+                    )
+                    if evicted:
+                        log.info(f'EVICTED {len(evicted)} OLD OUTPUTS')
+                except OSError:
+                    log.warning('COULD NOT EVICT OLD OUTPUTS', exc_info=True)
+
+                return str(out_file)
 
             else:
                 log.error('Empty/incomplete payload', exc_info=True)
                 raise ValueError('Empty/incomplete payload')
     
+@celery.task(bind=True)
+def call_batch(self, payloads):
+    """One catalog search for the whole batch, then one job per AOI like /api/download. Returns the group id."""
+    log.info(f"TASK ID: {self.request.id}")
+
+    from eo.image_utils import search_catalog_batch, unsign_items
+    from eo.modes.basic import BasicMode
+
+    # NOTE Each job gets its AOI's items with the task rather than through the search cache,
+    #  which a batch of more AOIs than its max_entries would evict before the jobs run
+    image_collections = [BasicMode(payload).image_collection for payload in payloads]
+    results = search_catalog_batch(image_collections)
+    log.info(f'SEARCHED {len(image_collections)} AOIS')
+
+    # Payloads already done or running, e.g. a batch sent twice, are joined and not run again
+    jobs = [submit_download(payload, items=unsign_items(items)) for payload, items in zip(payloads, results)]
+    log.info(f"SUBMITTED {sum(job == 'submitted' for _, job in jobs)} OF {len(jobs)} JOBS")
+
+    group_result = GroupResult(str(uuid4()), [AsyncResult(task_id) for task_id, _ in jobs], app=celery)
+    group_result.save()
+
+    return group_result.id
+
+@celery.task(bind=True)
+def call_zonal(self, data, output_format='json'):
+    """Rows of per-image statistics, or the path to them as Parquet"""
+    task_id = self.request.id
+    progress = JobProgress(callback=lambda state: PROGRESS.publish(task_id, state))
+    log.info(f"TASK ID: {task_id}")
+
+    try:
+        from eo.modes.zonal import ZonalStatsMode
+        out_dir = get_task_dir(task_id) if output_format == 'parquet' else None
+        result = ZonalStatsMode(data, progress, out_dir=out_dir).run(output_format=output_format)
+        return str(result) if output_format == 'parquet' else result
+    except Exception as e:
+        progress.fail(e)
+        log.error(f"TASK {task_id}: {AsyncResult(task_id).state}", exc_info=True)
+        raise
+
+def get_task_dir(task_id) -> str:
+    """Each task writes to a directory of its own, so jobs for different AOIs never overwrite each other's outputs"""
+    return f"{CONFIG['processed_images_directory']}/{task_id}"
+
+def get_mode(data, progress=None, out_dir=None, items=None):
+    """The mode that runs a payload, reporting to `progress` and writing to `out_dir`"""
+    if data.get('composite'):
+        from eo.modes.composite import CompositeMode
+        return CompositeMode(data, progress, out_dir, items)
+    if data.get('index'):
+        from eo.modes.index import IndexMode
+        return IndexMode(data, progress, out_dir, items)
+    if data.get('animation'):
+        from eo.modes.animation import AnimationMode
+        return AnimationMode(data, progress, out_dir, items)
+
+    from eo.modes.basic import BasicMode
+    return BasicMode(data, progress, out_dir, items)
+
+@lru_cache(maxsize=None)
+def warm_worker():
+    """Import the modes and load the collection metadata and boundaries once per worker process"""
+    start = time.perf_counter()
+    import eo.modes.composite, eo.modes.index, eo.modes.zonal, eo.modes.animation
+    from eo.boundaries import get_boundary_layer
+    from eo.image_utils import get_collection_item_assets
+    from eo.modes.basic import S2A, COLLECTION_CACHE, PH_BDRYS
+
+    get_collection_item_assets(S2A, **COLLECTION_CACHE)
+    if Path(PH_BDRYS).exists():
+        get_boundary_layer(PH_BDRYS).gdf
+    log.info(f'WARMED WORKER IN {round(time.perf_counter() - start, 2)}s')
+
+@worker_process_init.connect
+def warm_worker_process(**kwargs):
+    warm_worker() # Prefork pool children
+
+@worker_ready.connect
+def serve_worker_metrics(**kwargs):
+    warm_worker() # Solo, threads and gevent pools run the tasks in this process
+    start_http_server(CONFIG['telemetry']['metrics_port'])
+    log.info(f"SERVING METRICS ON PORT {CONFIG['telemetry']['metrics_port']}")
+
 @celery.task
 def test_celery():
     log.info('CELERY IS WORKING')
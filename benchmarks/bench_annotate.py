@@ -0,0 +1,95 @@
+"""Compare the matplotlib and pillow annotation renderers on a synthetic scene.
+
+Usage: python -m benchmarks.bench_annotate [--size 600] [--runs 5]
+"""
+import argparse
+import datetime
+import tempfile
+import time
+import numpy as np
+import geopandas as gpd
+import pystac
+import rasterio
+from pathlib import Path
+from rasterio.transform import from_origin
+from shapely.geometry import box
+from eo.base_image import BaseImage
+from eo.annotated_image import AnnotatedImage
+
+ORIGIN_X, ORIGIN_Y = 280000, 1560000 # Around Metro Manila in EPSG:32651
+
+
+def make_scene(tmp_dir: Path, size: int) -> pystac.Item:
+    """A visual COG with some structure so PNG encoding isn't trivially cheap"""
+    yy, xx = np.mgrid[0:size, 0:size]
+    rgb = np.stack([(xx * 255 // size), (yy * 255 // size), ((xx + yy) % 256)]).astype('uint8')
+    rgb += np.random.default_rng(0).integers(0, 32, rgb.shape, dtype='uint8')
+
+    href = tmp_dir / 'visual.tif'
+    with rasterio.open(
+        href, 'w', driver='COG', height=size, width=size, count=3, dtype='uint8',
+        crs='EPSG:32651', transform=from_origin(ORIGIN_X, ORIGIN_Y, 10, 10)
+    ) as dst:
+        dst.write(rgb)
+
+    item = pystac.Item(
+        'S2A_MSIL2A_20210725T021351_R060_T51PTS_20210725T115615', None, None,
+        datetime.datetime(2021, 7, 25, 2, 13, 51, 24000),
+        {'platform': 'Sentinel-2A', 'eo:cloud_cover': 12.3, 's2:mgrs_tile': '51PTS', 'proj:epsg': 32651}
+    )
+    item.properties['datetime'] = '2021-07-25T02:13:51.024000Z'
+    item.add_asset('visual', pystac.Asset(str(href)))
+
+    return item
+
+
+def make_boundaries(tmp_dir: Path, size: int) -> str:
+    """A 10x10 grid of municipalities over the scene"""
+    step = size * 10 / 10
+    cells = [
+        box(ORIGIN_X + i * step, ORIGIN_Y - (j + 1) * step, ORIGIN_X + (i + 1) * step, ORIGIN_Y - j * step)
+        for i in range(10) for j in range(10)
+    ]
+    gdf = gpd.GeoDataFrame(
+        {'NAME_1': ['Metropolitan Manila'] * len(cells), 'NAME_2': [f'Town {i}' for i in range(len(cells))]},
+        geometry=cells, crs='EPSG:32651'
+    )
+    path = tmp_dir / 'boundaries.gpkg'
+    gdf.to_file(path)
+
+    return str(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the annotation renderers')
+    parser.add_argument('--size', type=int, default=600, help='Scene width/height in pixels, 600 is a 3 km buffer')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--figsize', type=float, default=15)
+    parser.add_argument('--dpi', type=int, default=250)
+    parser.add_argument('--out', help='Directory to keep one PNG per renderer for a visual check')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp_dir = Path(tmp)
+        item = make_scene(tmp_dir, args.size)
+        boundaries = make_boundaries(tmp_dir, args.size)
+        extent = box(ORIGIN_X + 5, ORIGIN_Y - args.size * 10 + 5, ORIGIN_X + args.size * 10 - 5, ORIGIN_Y - 5)
+        annotated = AnnotatedImage(BaseImage(item, ['visual'], bbox=extent))
+        kwargs = dict(lon=121.0, lat=14.1, plot_bdry=True, figsize=args.figsize, dpi=args.dpi)
+
+        print(f'{"renderer":<12}{"mean s":>10}{"min s":>10}{"png KB":>10}')
+        for renderer in ('matplotlib', 'pillow'):
+            annotated.render(boundaries, renderer=renderer, **kwargs) # Warm up caches and fonts
+            timings = []
+            for _ in range(args.runs):
+                start = time.perf_counter()
+                filename, png_bytes = annotated.render(boundaries, renderer=renderer, **kwargs)
+                timings.append(time.perf_counter() - start)
+
+            print(f'{renderer:<12}{np.mean(timings):>10.3f}{np.min(timings):>10.3f}{len(png_bytes) / 1024:>10.0f}')
+            if args.out:
+                Path(args.out, f'{renderer}_{filename}').write_bytes(png_bytes)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""Import time of the web app and the CLI in fresh interpreters, against a budget.
+
+The web app (what gunicorn loads through data/wsgi.py) must not import the geospatial stack at all.
+Exits with 1 if a budget is exceeded or a heavy module is imported, so it can run in CI.
+
+Usage: python -m benchmarks.bench_imports [--runs 5] [--app-budget 1.0] [--cli-budget 1.0]
+"""
+import argparse
+import json
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+PROJECT_DIR = Path(__file__).resolve().parent.parent
+
+# Only the worker needs these
+HEAVY_MODULES = [
+    'numpy', 'pandas', 'rasterio', 'rioxarray', 'xarray', 'dask', 'geopandas', 'shapely', 'pyproj',
+    'matplotlib', 'PIL', 'osgeo', 'pystac', 'pystac_client', 'planetary_computer',
+]
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+print(json.dumps({{'seconds': time.perf_counter() - start, 'modules': sorted(sys.modules)}}))
+"""
+
+
+def time_import(module) -> dict:
+    output = subprocess.run(
+        [sys.executable, '-c', PROBE.format(module=module)],
+        cwd=PROJECT_DIR, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def time_command(args) -> float:
+    start = time.perf_counter()
+    subprocess.run([sys.executable, *args], cwd=PROJECT_DIR, capture_output=True, check=True)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark import times')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--app-budget', type=float, default=1.0, help='Seconds to import app.routes')
+    parser.add_argument('--cli-budget', type=float, default=1.0, help='Seconds for python -m eo --help')
+    args = parser.parse_args()
+
+    app_runs = [time_import('app.routes') for _ in range(args.runs)]
+    app_seconds = sorted(run['seconds'] for run in app_runs)[args.runs // 2]
+    heavy = [module for module in HEAVY_MODULES if module in app_runs[0]['modules']]
+
+    cli_seconds = sorted(time_command(['-m', 'eo', '--help']) for _ in range(args.runs))[args.runs // 2]
+    worker_seconds = sorted(time_import('eo.modes.basic')['seconds'] for _ in range(args.runs))[args.runs // 2]
+
+    print(f'{"":<28}{"median s":>10}{"budget s":>10}')
+    print(f'{"import app.routes":<28}{app_seconds:>10.3f}{args.app_budget:>10.3f}')
+    print(f'{"python -m eo --help":<28}{cli_seconds:>10.3f}{args.cli_budget:>10.3f}')
+    print(f'{"import eo.modes.basic":<28}{worker_seconds:>10.3f}{"-":>10}')
+
+    failed = False
+    if heavy:
+        print(f'app.routes imports {heavy}')
+        failed = True
+    if app_seconds > args.app_budget or cli_seconds > args.cli_budget:
+        print('Over the import time budget')
+        failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,350 @@
+"""Run BasicMode end to end against synthetic Sentinel-2 scenes served from localhost, no Planetary Computer.
+
+A local HTTP server stands in for the STAC API (landing page, /search, /collections) and for the blob
+storage (COGs with range requests). Each payload runs in its own process so peak RSS is per run.
+Stages are timed exclusive of the stages nested in them, e.g. render excludes its zip write.
+
+Usage: python -m benchmarks.bench_pipeline [--scenes 24] [--size 2048] [--runs 1] [--json report.json]
+"""
+import argparse
+import datetime
+import json
+import multiprocessing as mp
+import re
+import resource
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+import numpy as np
+import geopandas as gpd
+import rasterio
+from pyproj import Transformer
+from rasterio.transform import from_origin
+from shapely.geometry import box
+
+LON, LAT = 120.98, 14.6 # Metro Manila
+EPSG = 32651
+COLLECTION = 'sentinel-2-l2a'
+SNAPSHOT = Path(__file__).resolve().parent.parent / f'eo/collections/{COLLECTION}.json'
+
+SCENARIOS = {
+    'single': {'frequency': False},
+    'monthly': {'frequency': 'monthly'},
+    'yearly': {'frequency': 'yearly'},
+}
+STAGES = ['search', 'selection', 'bbox', 'band read', 'render', 'zip write']
+
+
+def get_origin(size: int) -> tuple:
+    """Top left of a scene of `size` 10 m pixels centered on the AOI"""
+    center_x, center_y = Transformer.from_crs(4326, EPSG, always_xy=True).transform(LON, LAT)
+    return center_x - size * 5, center_y + size * 5
+
+
+def make_boundaries(tmp_dir: Path, size: int) -> str:
+    """A 10x10 grid of municipalities over the scene"""
+    origin_x, origin_y = get_origin(size)
+    step = size * 10 / 10
+    cells = [
+        box(origin_x + i * step, origin_y - (j + 1) * step, origin_x + (i + 1) * step, origin_y - j * step)
+        for i in range(10) for j in range(10)
+    ]
+    gdf = gpd.GeoDataFrame(
+        {'NAME_1': ['Metropolitan Manila'] * len(cells), 'NAME_2': [f'Town {i}' for i in range(len(cells))]},
+        geometry=cells, crs=f'EPSG:{EPSG}'
+    )
+    path = tmp_dir / 'boundaries.gpkg'
+    gdf.to_file(path)
+
+    return str(path)
+
+
+def make_scenes(data_dir: Path, n_scenes: int, size: int) -> list:
+    """STAC items of one MGRS tile over a year, each with visual, B02-B04 and SCL COGs with overviews"""
+    origin_x, origin_y = get_origin(size)
+    to_lonlat = Transformer.from_crs(EPSG, 4326, always_xy=True)
+    corners = [to_lonlat.transform(x, y) for x, y in [
+        (origin_x, origin_y), (origin_x + size * 10, origin_y),
+        (origin_x + size * 10, origin_y - size * 10), (origin_x, origin_y - size * 10)
+    ]]
+    lons, lats = zip(*corners)
+
+    rng = np.random.default_rng(0)
+    cloud_cover = np.random.default_rng(1).uniform(0, 80, n_scenes) # Same catalog whether or not the COGs are reused
+    yy, xx = np.mgrid[0:size, 0:size]
+    base = (np.sin(xx / 40) + np.cos(yy / 55)) * 600 + 1500
+    profile = dict(driver='COG', crs=f'EPSG:{EPSG}', nodata=0, compress='deflate', blocksize=512)
+
+    items = []
+    for i in range(n_scenes):
+        dt = datetime.datetime(2024, 1, 1, 2, 13, 51) + datetime.timedelta(days=i * 366 // n_scenes)
+        item_id = f'S2A_MSIL2A_{dt:%Y%m%dT%H%M%S}_R060_T51PTS_{dt:%Y%m%dT%H%M%S}'
+        scene_dir = data_dir / item_id
+        scene_dir.mkdir(parents=True, exist_ok=True)
+
+        if not (scene_dir / 'SCL.tif').exists():
+            bands = {
+                band: (base * (1 + 0.1 * j) + rng.integers(0, 200, base.shape)).astype('uint16')
+                for j, band in enumerate(['B04', 'B03', 'B02'])
+            }
+            for band, data in bands.items():
+                with rasterio.open(scene_dir / f'{band}.tif', 'w', height=size, width=size, count=1, dtype='uint16',
+                                   transform=from_origin(origin_x, origin_y, 10, 10), **profile) as dst:
+                    dst.write(data, 1)
+
+            visual = np.stack([np.clip(data // 12, 1, 255) for data in bands.values()]).astype('uint8')
+            with rasterio.open(scene_dir / 'visual.tif', 'w', height=size, width=size, count=3, dtype='uint8',
+                               transform=from_origin(origin_x, origin_y, 10, 10), **profile) as dst:
+                dst.write(visual)
+
+            scl = rng.choice(np.array([4, 5, 6, 8, 9], dtype='uint8'), (size // 2, size // 2), p=[.4, .2, .1, .2, .1])
+            with rasterio.open(scene_dir / 'SCL.tif', 'w', height=size // 2, width=size // 2, count=1, dtype='uint8',
+                               transform=from_origin(origin_x, origin_y, 20, 20), **profile) as dst:
+                dst.write(scl, 1)
+
+        items.append({
+            'type': 'Feature', 'stac_version': '1.0.0', 'id': item_id, 'collection': COLLECTION,
+            'geometry': {'type': 'Polygon', 'coordinates': [[*corners, corners[0]]]},
+            'bbox': [min(lons), min(lats), max(lons), max(lats)],
+            'properties': {
+                'datetime': f'{dt:%Y-%m-%dT%H:%M:%S}.024000Z',
+                'platform': 'Sentinel-2A',
+                'eo:cloud_cover': float(cloud_cover[i]),
+                's2:mgrs_tile': '51PTS',
+                's2:processing_baseline': '05.10',
+                's2:datatake_id': f'GS2A_{dt:%Y%m%dT%H%M%S}_000000_N05.10',
+                'proj:epsg': EPSG,
+            },
+            'assets': {band: {'href': f'/data/{item_id}/{band}.tif', 'type': 'image/tiff'}
+                       for band in ['visual', 'B04', 'B03', 'B02', 'SCL']},
+            'links': [],
+        })
+
+    return items
+
+
+class StacHandler(BaseHTTPRequestHandler):
+    """Minimal STAC API item search plus static files with range requests"""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body: bytes, content_type='application/json', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+            self.server.count(len(body))
+
+    def _send_json(self, data):
+        self._send(200, json.dumps(data).encode())
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        root = self.server.url
+        if self.path == '/':
+            return self._send_json({
+                'type': 'Catalog', 'id': 'bench', 'description': 'Local stand-in', 'stac_version': '1.0.0',
+                'conformsTo': ['https://api.stacspec.org/v1.0.0/core', 'https://api.stacspec.org/v1.0.0/item-search'],
+                'links': [
+                    {'rel': 'self', 'href': f'{root}/'}, {'rel': 'root', 'href': f'{root}/'},
+                    {'rel': 'search', 'href': f'{root}/search', 'method': 'POST', 'type': 'application/geo+json'},
+                ],
+            })
+        if self.path == f'/collections/{COLLECTION}':
+            return self._send(200, SNAPSHOT.read_bytes())
+        if self.path.startswith('/data/'):
+            return self._send_file(self.server.data_dir / self.path.removeprefix('/data/'))
+
+        self._send(404, b'{}')
+
+    def _send_file(self, path: Path):
+        if not path.is_file():
+            return self._send(404, b'')
+
+        size = path.stat().st_size
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if not match:
+            return self._send(200, path.read_bytes(), 'image/tiff', {'Accept-Ranges': 'bytes'})
+
+        start = int(match.group(1))
+        end = min(int(match.group(2) or size - 1), size - 1)
+        with open(path, 'rb') as f:
+            f.seek(start)
+            body = f.read(end - start + 1)
+        self._send(206, body, 'image/tiff', {'Accept-Ranges': 'bytes', 'Content-Range': f'bytes {start}-{end}/{size}'})
+
+    def do_POST(self):
+        if self.path != '/search':
+            return self._send(404, b'{}')
+
+        query = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        start, end = query['datetime'].split('/')
+        geometry = query.get('intersects') or {}
+        points = geometry['coordinates'] if geometry.get('type') == 'MultiPoint' else [geometry.get('coordinates')]
+
+        features = []
+        for item in self.server.items:
+            xmin, ymin, xmax, ymax = item['bbox']
+            covered = any(point and xmin <= point[0] <= xmax and ymin <= point[1] <= ymax for point in points)
+            if covered and start <= item['properties']['datetime'] <= end:
+                features.append({
+                    **item,
+                    'assets': {k: {**v, 'href': f'{self.server.url}{v["href"]}'} for k, v in item['assets'].items()}
+                })
+
+        self._send(200, json.dumps({'type': 'FeatureCollection', 'features': features, 'links': []}).encode(),
+                   'application/geo+json')
+
+
+class StacServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, items, data_dir: Path, requests, bytes_sent):
+        super().__init__(('127.0.0.1', 0), StacHandler)
+        self.items = items
+        self.data_dir = data_dir
+        self.url = f'http://127.0.0.1:{self.server_port}'
+        self.requests = requests
+        self.bytes_sent = bytes_sent
+
+    def count(self, n_bytes):
+        with self.requests.get_lock():
+            self.requests.value += 1
+            self.bytes_sent.value += n_bytes
+
+
+class StageRecorder:
+    """Wall time, bytes and requests per stage, nested stages are subtracted from the stage they run in"""
+    def __init__(self, requests, bytes_sent):
+        self.requests = requests
+        self.bytes_sent = bytes_sent
+        self.totals = {stage: {'calls': 0, 'seconds': 0.0, 'bytes': 0, 'requests': 0} for stage in STAGES}
+        self._stack = []
+        self._lock = threading.Lock()
+
+    def _snapshot(self):
+        return np.array([time.perf_counter(), self.bytes_sent.value, self.requests.value])
+
+    def wrap(self, stage, func):
+        def wrapped(*args, **kwargs):
+            with self._lock:
+                self._stack.append(np.zeros(3))
+            start = self._snapshot()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                spent = self._snapshot() - start
+                with self._lock:
+                    nested = self._stack.pop()
+                    if self._stack:
+                        self._stack[-1] += spent
+                    own = spent - nested
+                    total = self.totals[stage]
+                    total['calls'] += 1
+                    total['seconds'] += float(own[0])
+                    total['bytes'] += int(own[1])
+                    total['requests'] += int(own[2])
+        return wrapped
+
+
+def run_scenario(payload, server_url, boundaries, out_dir, requests, bytes_sent, results):
+    """Child process: point the repo at the local server, instrument the stages and run BasicMode"""
+    import eo.archive
+    import eo.image_utils
+    import eo.modes.basic as basic
+
+    eo.image_utils.STAC_API_URL = server_url
+    basic.SEARCH_CACHE = eo.image_utils.SearchCache(ttl=0)
+    basic.WINDOW_CACHE = None
+    basic.PROCESSED_IMG_DIR = out_dir
+    basic.PH_BDRYS = boundaries
+
+    recorder = StageRecorder(requests, bytes_sent)
+    basic.search_catalog = recorder.wrap('search', basic.search_catalog)
+    basic.BasicMode.select_images = recorder.wrap('selection', basic.BasicMode.select_images)
+    basic.get_item_bbox = recorder.wrap('bbox', basic.get_item_bbox)
+    basic.clip_image = recorder.wrap('band read', basic.clip_image)
+    basic.export_image = recorder.wrap('render', basic.export_image)
+    eo.archive.JobArchive.write = recorder.wrap('zip write', eo.archive.JobArchive.write)
+
+    start = time.perf_counter()
+    basic.BasicMode(payload).run()
+    results.put({
+        'seconds': time.perf_counter() - start,
+        'stages': recorder.totals,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark BasicMode.run() offline')
+    parser.add_argument('--scenes', type=int, default=24, help='Scenes over 2024 in the local catalog')
+    parser.add_argument('--size', type=int, default=2048, help='Scene width/height in 10 m pixels')
+    parser.add_argument('--buffer', type=float, default=3, help='Buffer in km')
+    parser.add_argument('--runs', type=int, default=1)
+    parser.add_argument('--scenarios', nargs='+', default=list(SCENARIOS), choices=list(SCENARIOS))
+    parser.add_argument('--no-annotate', action='store_true', help='Export GeoTIFFs instead of annotated PNGs')
+    parser.add_argument('--data', help='Directory to keep the synthetic COGs in between runs')
+    parser.add_argument('--json', help='Write the report to this file')
+    args = parser.parse_args()
+
+    ctx = mp.get_context('spawn')
+    requests, bytes_sent = ctx.Value('q', 0), ctx.Value('q', 0)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        data_dir = Path(args.data or tmp) / 'scenes'
+        start = time.perf_counter()
+        items = make_scenes(data_dir, args.scenes, args.size)
+        boundaries = make_boundaries(Path(tmp), args.size)
+        print(f'{len(items)} SCENES OF {args.size}x{args.size} IN {time.perf_counter() - start:.1f}s')
+
+        server = StacServer(items, data_dir, requests, bytes_sent)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        report = []
+        for scenario in args.scenarios:
+            payload = {
+                'start_date': '2024-01-01', 'end_date': '2024-12-31', 'latitude': LAT, 'longitude': LON,
+                'buffer': args.buffer, 'annotate': not args.no_annotate, 'boundary': not args.no_annotate,
+                'export_all': False, 'to_zip': True, 'workers': 1, **SCENARIOS[scenario]
+            }
+            for run in range(args.runs):
+                out_dir = Path(tmp) / f'{scenario}_{run}'
+                out_dir.mkdir()
+                results = ctx.Queue()
+                process = ctx.Process(target=run_scenario, args=(
+                    payload, server.url, boundaries, str(out_dir), requests, bytes_sent, results
+                ))
+                process.start()
+                process.join()
+                if process.exitcode != 0:
+                    raise RuntimeError(f'{scenario} run {run} failed, see the traceback above')
+                result = results.get()
+                report.append({'scenario': scenario, 'run': run, **result})
+
+        server.shutdown()
+
+    print(f'\n{"scenario":<10}{"stage":<12}{"calls":>7}{"wall s":>9}{"MB read":>9}{"requests":>10}')
+    for result in report:
+        for stage, total in result['stages'].items():
+            print(f'{result["scenario"]:<10}{stage:<12}{total["calls"]:>7}{total["seconds"]:>9.3f}'
+                  f'{total["bytes"] / 1024 ** 2:>9.2f}{total["requests"]:>10}')
+        print(f'{result["scenario"]:<10}{"total":<12}{"":>7}{result["seconds"]:>9.3f}'
+              f'{"":>9}{"":>10}   peak RSS {result["peak_rss_mb"]:.0f} MB\n')
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,7 +2,6 @@ import argparse
 import json
 from . import PROJECT_DIR
 from eo.logger import logger
-from eo.modes.basic import BasicMode
 
 if __name__ == "__main__":
     log = logger(PROJECT_DIR / 'logs/eo.log')
@@ -48,6 +47,8 @@ if __name__ == "__main__":
     ALL = payload_dict['all']
     TO_ZIP = payload_dict['to_zip']
 
+    from eo.modes.basic import BasicMode # After parsing so --help and argument errors return right away
+
     log.info('CALLING VIA CLI')
     basic_mode = BasicMode({
         "start_date": START_DATE,
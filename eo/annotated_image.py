@@ -1,13 +1,18 @@
 import matplotlib
 import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 import numpy as np
-import geopandas as gpd
 import rioxarray as rxr
-import zipfile
 import io
 from pathlib import Path
 from eo.base_image import BaseImage
-from eo.utils import simplify_datetime, list_intersecting_municipalities
+from eo.boundaries import get_boundary_layer
+from eo.telemetry import span
+from eo.utils import simplify_datetime
+from functools import lru_cache
+from PIL import Image, ImageDraw, ImageFont
+import shapely
 
 # NOTE Since the rasters are Xarrays which triggers "lazy computation"/parallelization,
 #  Matplotlib raises a warning since it defaults to a GUI backend/viewer.
@@ -15,6 +20,18 @@ from eo.utils import simplify_datetime, list_intersecting_municipalities
 #  https://stackoverflow.com/a/74471578/12779978
 matplotlib.use('agg')
 
+# Fraction of a square pyplot figure that the default axes take, used to size the pillow renders the same
+PYPLOT_AXES_FRACTION = 0.77
+
+
+@lru_cache(maxsize=None)
+def _load_font(size:int) -> ImageFont.FreeTypeFont:
+    """DejaVu Sans is what pyplot falls back to when Helvetica is missing"""
+    try:
+        return ImageFont.truetype(str(Path(matplotlib.get_data_path()) / 'fonts/ttf/DejaVuSans.ttf'), size)
+    except OSError:
+        return ImageFont.load_default(size=size)
+
 
 class AnnotatedImage:
     def __init__(
@@ -33,14 +50,50 @@ class AnnotatedImage:
         self.clipped = None
 
 
-    def annotate(self, boundaries:gpd.GeoDataFrame, out_dir, **kwargs):
-        """Add texts to a plot"""
+    def render(self, boundaries:str, renderer:str = 'matplotlib', **kwargs) -> tuple:
+        """Annotate the image with the matplotlib or pillow backend and return the PNG filename and bytes"""
         lon = kwargs.get('lon')
         lat = kwargs.get('lat')
+
+        # Clip and reproject boundary layer, loaded once per process
+        boundary_layer = get_boundary_layer(boundaries)
+        crs = self.true_color.rio.crs
+        clipped_bdrys = boundary_layer.intersecting(self.extent, crs)
+
+        # Add text
+        capture_date = simplify_datetime(self.image_properties['datetime'])
+        platform = self.image_properties['platform']
+        cloud_cover = self.image_properties['eo:cloud_cover']
+        map_center = f"{round(float(lon), 3)}, {round(float(lat), 3)}"
+        intersecting = boundary_layer.municipalities(self.extent, crs)
+        munis = ','.join(intersecting['towns'])
+        province = intersecting['province']
+        captions = [
+            f'From {platform} with image ID of {self.image_id}',
+            f'Captured on {capture_date} with {int(cloud_cover)}% cloud cover',
+            f'Shows {munis} in {province} with center at {map_center}',
+        ]
+        
+        # Alternative filename - self.image_id is S2A_MSIL2A_20210725T021351_R060_T51PZL_20210725T115615 so it cannot be ordered by date
+        capture_date_compact = simplify_datetime(self.image_properties['datetime'], compact=True)
+        tile_id = self.image_properties['s2:mgrs_tile']
+        alt_image_id = f"{capture_date_compact}_{platform}_{tile_id}"
+
+        with span('render', image_id=self.image_id, renderer=renderer):
+            if renderer == 'matplotlib':
+                png_bytes = self._render_matplotlib(clipped_bdrys, captions, **kwargs)
+            elif renderer == 'pillow':
+                png_bytes = self._render_pillow(clipped_bdrys, captions, **kwargs)
+            else:
+                raise ValueError(f'Unknown annotation renderer: {renderer}')
+
+        return f'{alt_image_id}.png', png_bytes
+
+
+    def _render_matplotlib(self, clipped_bdrys, captions:list, **kwargs) -> bytes:
         figsize = kwargs.get('figsize')
         plot_boundary = kwargs.get('plot_bdry')
         dpi = kwargs.get('dpi')
-        out_zip = kwargs.get('out_zip')
 
         # Reorder the array for pyplot
         image = self.true_color.values
@@ -49,47 +102,79 @@ class AnnotatedImage:
         # Get bbox and reorder extent for pyplot
         min_x, min_y, max_x, max_y = self.extent.bounds
         reordered_extent = (min_x, max_x, min_y, max_y)
-
-        # Clip and reproject boundary layer
-        boundaries = gpd.read_file(boundaries).to_crs(self.true_color.rio.crs)
-        clipped_bdrys = boundaries.clip(self.extent)
         
-        # Plot the raster and then vector
-        fig, ax = plt.subplots(figsize=(figsize, figsize))
+        # Plot the raster and then vector, on a figure of its own instead of pyplot's current figure,
+        # which is shared by every thread of the process
+        fig = Figure(figsize=(figsize, figsize))
+        FigureCanvasAgg(fig)
+        ax = fig.subplots()
         ax.imshow(image, extent=reordered_extent)
         if plot_boundary:
             clipped_bdrys.boundary.plot(ax=ax, edgecolor='white', linewidth=0.15)    
 
-        # Add text
-        capture_date = simplify_datetime(self.image_properties['datetime'])
-        platform = self.image_properties['platform']
-        cloud_cover = self.image_properties['eo:cloud_cover']
-        map_center = f"{round(float(lon), 3)}, {round(float(lat), 3)}"
-        munis = ','.join(list_intersecting_municipalities(clipped_bdrys)['towns'])
-        province = list_intersecting_municipalities(clipped_bdrys)['province']
-        
-        # Alternative filename - self.image_id is S2A_MSIL2A_20210725T021351_R060_T51PZL_20210725T115615 so it cannot be ordered by date
-        capture_date_compact = simplify_datetime(self.image_properties['datetime'], compact=True)
-        tile_id = self.image_properties['s2:mgrs_tile']
-        alt_image_id = f"{capture_date_compact}_{platform}_{tile_id}"
+        ax.axis('off')
+        for caption, y in zip(captions, (0.09, 0.07, 0.05)):
+            fig.text(0.13, y, caption, ha='left', va='bottom', fontname='Helvetica', fontsize=12)
 
-        out_file = f'{out_dir}/{alt_image_id}.png'
-        plt.axis('off')
-        plt.figtext(0.13, 0.09, f'From {platform} with image ID of {self.image_id}', ha='left', va='bottom', fontname='Helvetica', fontsize=12)
-        plt.figtext(0.13, 0.07, f'Captured on {capture_date} with {int(cloud_cover)}% cloud cover', ha='left', va='bottom', fontname='Helvetica', fontsize=12)
-        plt.figtext(0.13, 0.05, f'Shows {munis} in {province} with center at {map_center}', ha='left', va='bottom', fontname='Helvetica', fontsize=12)
+        buf = io.BytesIO()
+        with span('encode', image_id=self.image_id, format='PNG'):
+            fig.savefig(buf, dpi=dpi, bbox_inches='tight')
 
-        if out_zip:
-            if Path(out_zip).exists:
-                mode = 'a'
-            else:
-                mode = 'w'
-            with zipfile.ZipFile(out_zip, mode=mode, compression=zipfile.ZIP_DEFLATED) as zf:
-                buf = io.BytesIO()
-                plt.savefig(buf, dpi=dpi, bbox_inches='tight')
-                plt.close()
-                zf.writestr(f'{alt_image_id}.png', buf.getvalue())
-            out_file = Path(out_zip).resolve()
+        return buf.getvalue()
+
+
+    def _render_pillow(self, clipped_bdrys, captions:list, **kwargs) -> bytes:
+        """Compose the RGB array, boundary lines and captions directly instead of through a pyplot figure"""
+        figsize = kwargs.get('figsize')
+        plot_boundary = kwargs.get('plot_bdry')
+        dpi = kwargs.get('dpi')
+
+        image = np.ascontiguousarray(np.moveaxis(self.true_color.values[:3], 0, -1))
+        height, width = image.shape[:2]
+
+        # Same image size as the pyplot path where the default axes take 77% of the square figure
+        scale = figsize * dpi * PYPLOT_AXES_FRACTION / max(height, width)
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        font_size = round(12 * dpi / 72) # 12pt like the pyplot captions
+        line_height = round(font_size * 1.25)
+
+        canvas = Image.new('RGB', (size[0], size[1] + line_height * (len(captions) + 1)), 'white')
+        canvas.paste(Image.fromarray(image).resize(size, Image.Resampling.NEAREST), (0, 0))
+        draw = ImageDraw.Draw(canvas)
+
+        if plot_boundary and len(clipped_bdrys) > 0:
+            # Map the boundaries from the raster's CRS to pixels of the resized image
+            min_x, min_y, max_x, max_y = self.extent.bounds
+            x_scale = size[0] / (max_x - min_x)
+            y_scale = size[1] / (max_y - min_y)
+            line_width = max(1, round(0.15 * dpi / 72))
+
+            for line in shapely.get_parts(clipped_bdrys.boundary.values):
+                coords = shapely.get_coordinates(line)
+                pixels = np.column_stack([(coords[:, 0] - min_x) * x_scale, (max_y - coords[:, 1]) * y_scale])
+                draw.line(pixels.ravel().tolist(), fill='white', width=line_width)
+
+        font = _load_font(font_size)
+        for index, caption in enumerate(captions):
+            draw.text((0, size[1] + line_height * (index + 0.5)), caption, fill='black', font=font)
+
+        buf = io.BytesIO()
+        with span('encode', image_id=self.image_id, format='PNG'):
+            canvas.save(buf, format='PNG', compress_level=3) # Most of the render time is zlib, 3 is ~25% faster than 6 for ~7% more bytes
+
+        return buf.getvalue()
+
+
+    def annotate(self, boundaries:str, out_dir, archive=None, **kwargs):
+        """Add texts to a plot and write it to out_dir or an open :class:`JobArchive`"""
+        filename, png_bytes = self.render(boundaries, **kwargs)
+
+        if archive is not None:
+            return archive.write(filename, png_bytes)
+
+        out_file = f'{out_dir}/{filename}'
+        with open(out_file, 'wb') as f:
+            f.write(png_bytes)
 
         return out_file
 
@@ -0,0 +1,109 @@
+import shutil
+import struct
+import threading
+import time
+import zipfile
+import zlib
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterator, Union
+from eo.telemetry import span
+
+# Already compressed formats gain nothing from another DEFLATE pass
+STORED_SUFFIXES = ('.tif', '.tiff', '.png', '.gif', '.jpg', '.zip')
+
+
+class JobArchive:
+    """Zip archive of a job's outputs that stays open for the whole run.
+
+    Entries are streamed from bytes or file-like objects in chunks so large GeoTIFFs are never
+    copied into Python bytes, and a lock lets the per-image workers write to the same archive.
+    """
+    def __init__(self, out_zip:Union[str, Path], chunk_size:int = 1024 * 1024):
+        self.path = Path(out_zip).resolve()
+        self.chunk_size = chunk_size
+        self.entries = []
+        self._zf = None
+        self._lock = threading.Lock()
+
+
+    def open(self) -> "JobArchive":
+        mode = 'a' if self.path.exists() else 'w'
+        self._zf = zipfile.ZipFile(self.path, mode=mode, allowZip64=True)
+
+        return self
+
+
+    def close(self):
+        if self._zf is not None:
+            self._zf.close()
+            self._zf = None
+
+
+    def __enter__(self) -> "JobArchive":
+        return self.open()
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+    def write(self, name:str, data:Union[bytes, BinaryIO], compress:Union[bool, None] = None) -> Path:
+        """Add an entry, stored or deflated by file type unless `compress` is given"""
+        if self._zf is None:
+            raise ValueError('Archive is not open. Use open() or a with block first.')
+
+        if compress is None:
+            compress = not name.lower().endswith(STORED_SUFFIXES)
+
+        zinfo = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+        zinfo.compress_type = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+
+        with self._lock, span('zip write', entry=name):
+            with self._zf.open(zinfo, mode='w', force_zip64=True) as dst:
+                if isinstance(data, (bytes, bytearray, memoryview)):
+                    dst.write(data)
+                else:
+                    shutil.copyfileobj(data, dst, self.chunk_size)
+            self._zf.fp.flush() # So finished entries can be read while the job runs, see iter_entry()
+            self.entries.append(name)
+
+        return self.path
+
+
+    def locate(self, name:str) -> Dict:
+        """Where a written entry is in the file, for :func:`iter_entry`"""
+        zinfo = self._zf.getinfo(name)
+        return {
+            'archive': str(self.path),
+            'offset': zinfo.header_offset,
+            'bytes': zinfo.compress_size,
+            'compress_type': zinfo.compress_type,
+        }
+
+
+def iter_entry(archive:Union[str, Path], offset:int, size:int, compress_type:int, chunk_size:int = 1024 * 1024) -> Iterator[bytes]:
+    """Stream an entry's content from its local header, given its offset and compressed size from :meth:`JobArchive.locate`.
+
+    The central directory is only written when the archive is closed, so zipfile cannot open it
+    while the job is still running.
+    """
+    with open(archive, 'rb') as f:
+        f.seek(offset)
+        header = f.read(30)
+        if header[:4] != b'PK\x03\x04':
+            raise ValueError(f'No zip entry at offset {offset} of {archive}')
+
+        name_length, extra_length = struct.unpack('<HH', header[26:30])
+        f.seek(offset + 30 + name_length + extra_length)
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS) if compress_type == zipfile.ZIP_DEFLATED else None
+
+        remaining = size
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                raise EOFError(f'{archive} ended before the entry at offset {offset}')
+            remaining -= len(chunk)
+            yield decompressor.decompress(chunk) if decompressor else chunk
+
+        if decompressor:
+            yield decompressor.flush()
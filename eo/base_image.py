@@ -3,14 +3,34 @@ import rioxarray as rxr
 import xarray as xr
 import numpy as np
 import rasterio 
-import zipfile
-from osgeo import gdal
 from rasterio.plot import plotting_extent
 from rasterio.windows import from_bounds
+from rasterio.transform import from_bounds as transform_from_bounds
+from rasterio.crs import CRS
+from rasterio.vrt import WarpedVRT
+from rasterio.enums import Resampling
 from rasterio.io import MemoryFile
+from affine import Affine
 from shapely.geometry import box
 from typing import Dict, List, Union, AnyStr
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from eo.archive import JobArchive
+from eo.pool import native_threads
+from eo.stretch import stretch_bands
+from eo.telemetry import span
+
+# GDAL settings shared by every windowed COG read so concurrent band reads reuse
+# the same HTTP behaviour: no directory listing on open, HTTP/2 multiplexing and
+# merged range requests for the tiles of a window.
+COG_ENV_OPTIONS = {
+    'GDAL_DISABLE_READDIR_ON_OPEN': 'EMPTY_DIR',
+    'CPL_VSIL_CURL_ALLOWED_EXTENSIONS': '.tif,.tiff',
+    'GDAL_HTTP_MULTIPLEX': 'YES',
+    'GDAL_HTTP_VERSION': '2',
+    'GDAL_HTTP_MERGE_CONSECUTIVE_RANGES': 'YES',
+    'VSI_CACHE': 'TRUE',
+}
 
 class BaseImage:
     def __init__(
@@ -35,6 +55,14 @@ class BaseImage:
         self.clip(band_list, bbox)
 
 
+    def __getstate__(self) -> Dict:
+        """Pickled without the `window_cache` kwarg, e.g. for a render process pool, since its lock cannot be.
+        The cache is only used while clipping."""
+        state = self.__dict__.copy()
+        state['kwargs'] = {key: value for key, value in self.kwargs.items() if key != 'window_cache'}
+        return state
+
+
     def get_individual_bands(self) -> Dict:
         """Get the individual bands (e.g. Red, Green, and Blue) from the selected image."""
         return {
@@ -46,72 +74,170 @@ class BaseImage:
     
     
     def clip(self, band_list:list, bbox):
-        """Clips the PySTAC item's RGB and visual assets with a shapely box"""
-        self.individual_bands_arr = {}
+        """Clips the PySTAC item's RGB and visual assets with a shapely box.
+        
+        Set the `band_workers` kwarg above 1 to read the bands concurrently so the latency of
+        a scene is close to its slowest band instead of the sum of all bands. This needs real threads:
+        under a gevent Celery pool the bands are read one after another.
+        """
+        band_workers = min(int(self.kwargs.get('band_workers') or 1), len(band_list))
+
+        if band_workers > 1 and native_threads():
+            with ThreadPoolExecutor(max_workers=band_workers) as pool:
+                arrays = list(pool.map(lambda band: self._read_band(band, bbox), band_list))
+        else:
+            arrays = [self._read_band(band, bbox) for band in band_list]
+
+        self.individual_bands_arr = dict(zip(band_list, arrays))
+        self.true_color = self.individual_bands_arr.get('visual')
 
-        for band in band_list:
-            cog = self.image_item.assets[band].href
 
-            with rasterio.open(cog) as src:
+    def _read_band(self, band, bbox) -> xr.DataArray:
+        """Read the window of one asset within the bbox, through the `window_cache` kwarg if set.
+
+        Items in the `mosaic_items` kwarg fill the pixels of the window that this item has no data for.
+        The `out_shape` kwarg (height, width) resamples every band onto the same grid, e.g. 20 m bands to 10 m.
+        The `crs` kwarg is the CRS of the bbox if it is not the item's own, the asset is then warped onto it.
+        """
+        cog = self.image_item.assets[band].href
+        mosaic_cogs = [item.assets[band].href for item in self.kwargs.get('mosaic_items') or []]
+        out_shape = self.kwargs.get('out_shape')
+        crs = self.kwargs.get('crs')
+        window_cache = self.kwargs.get('window_cache')
+
+        with span('band read', image_id=self.image_item.id, band=band) as record:
+            if window_cache is not None:
+                key = window_cache.key([cog, *mosaic_cogs], bbox.bounds, out_shape, crs=crs)
+                cached = window_cache.get(key)
+                record['cache_hit'] = cached is not None
+                if cached is not None:
+                    return self._to_dataarray(*cached)
+
+            data, attrs = self._read_window(cog, bbox, mosaic_cogs, out_shape, crs=crs)
+            record['shape'] = list(data.shape)
+
+            if window_cache is not None:
+                window_cache.put(key, data, attrs)
+
+        return self._to_dataarray(data, attrs)
+
+
+    @staticmethod
+    def _warp(src, crs, transform, width, height) -> tuple:
+        """Pixels of a dataset warped onto a grid and the mask of those it had data for. The warped VRT only
+        fetches the source blocks under the grid, and the alpha band marks the pixels it had source data for."""
+        with WarpedVRT(
+            src, crs=crs, transform=transform, width=width, height=height,
+            resampling=Resampling.nearest, add_alpha=True
+        ) as vrt:
+            data = vrt.read(indexes=list(range(1, src.count + 1)))
+            valid = vrt.dataset_mask() > 0
+
+        return data, valid
+
+
+    @staticmethod
+    def _read_window(cog, bbox, mosaic_cogs:List = None, out_shape:tuple = None, crs = None) -> tuple:
+        """Returns the pixels of the COG within the bbox and their georeferencing.
+
+        A bbox in another `crs` than the COG's is read by warping the COG onto the bbox, e.g. so the frames of
+        an animation line up across UTM zones. When mosaicking, the window is read boundless so it spans the
+        whole bbox, then the pixels outside the dataset mask are filled from each of `mosaic_cogs` warped onto
+        the same grid. The masks come from each COG's nodata or internal mask, not from the pixel values, so
+        real zero reflectances are kept.
+        """
+        # GDAL config is per thread so each read enters the shared environment itself
+        with rasterio.Env(**COG_ENV_OPTIONS), rasterio.open(cog) as src:
+            fill_value = src.nodata or 0
+            valid = None
+
+            if crs is not None and CRS.from_user_input(crs) != src.crs:
+                crs = CRS.from_user_input(crs)
+                minx, miny, maxx, maxy = bbox.bounds
+                height, width = out_shape or (
+                    max(1, round((maxy - miny) / src.res[1])), max(1, round((maxx - minx) / src.res[0]))
+                )
+                transform = transform_from_bounds(minx, miny, maxx, maxy, width, height)
+                data, valid = BaseImage._warp(src, crs, transform, width, height)
+                res = ((maxx - minx) / width, (maxy - miny) / height)
+            else:
                 window = from_bounds(*bbox.bounds, transform=src.transform)
-                data = src.read(window=window) # Only read the data within the window
-                transform = src.window_transform(window)
-                crs = src.crs
-                count, height, width = data.shape
-                coords = {
-                    "band": list(range(1, count + 1)),
-                    "y": np.arange(height) * transform.e + transform.f,
-                    "x": np.arange(width) * transform.a + transform.c
-                }
-                
-                kwargs = src.meta.copy()
-                kwargs.update({
-                    'height': window.height,
-                    'width': window.width,
-                    'transform': transform
-                })
-
-                # Convert the numpy array to xarray for consistency
-                da = xr.DataArray(
-                    data,
-                    dims=("band", "y", "x"),
-                    coords=coords,
-                    attrs={
-                        "transform": transform,
-                        "crs": crs.to_string() if crs else None,
-                        "res": src.res,
-                        "nodata": src.nodata
-                    }
+                data = src.read( # Only read the data within the window
+                    window=window, boundless=bool(mosaic_cogs), fill_value=fill_value,
+                    out_shape=(src.count, *out_shape) if out_shape else None
                 )
+                count, height, width = data.shape
+                transform = src.window_transform(window) * Affine.scale(window.width / width, window.height / height)
+                res = (src.res[0] * window.width / width, src.res[1] * window.height / height)
+                crs = src.crs
+                if mosaic_cogs:
+                    valid = src.dataset_mask(window=window, out_shape=(height, width), boundless=True) > 0
 
-                self.individual_bands_arr[band] = da
-        self.true_color = self.individual_bands_arr.get('visual')
+            for mosaic_cog in mosaic_cogs or []:
+                if valid.all():
+                    break
+
+                with rasterio.open(mosaic_cog) as mosaic_src:
+                    patch, patch_valid = BaseImage._warp(mosaic_src, crs, transform, width, height)
+                fill = ~valid & patch_valid
+                data[:, fill] = patch[:, fill]
+                valid |= fill
+
+            if valid is not None:
+                data[:, ~valid] = fill_value # Holes left by every COG, whatever values their masks hid
+
+            # JSON-friendly so the window cache can store them as is
+            attrs = {
+                "transform": list(transform)[:6],
+                "crs": crs.to_string() if crs else None,
+                "res": list(res),
+                "nodata": src.nodata
+            }
+
+        return data, attrs
 
 
     @staticmethod
-    def _stretch_contrast(band_array, lower, upper, nodataval) -> xr.DataArray:
-        # Pre-filter the band
-        band_array = band_array.astype(np.float32)
-        masked_array = band_array.where(band_array != nodataval)
-
-        # Get the value at the XX% (low) and XX% (high) percentile
-        p_low_da = masked_array.quantile(lower / 100.0, skipna=True)
-        p_high_da = masked_array.quantile(upper / 100.0, skipna=True)
-        p_low = float(p_low_da)
-        p_high = float(p_high_da)
-
-        # Stretch and clip the band
-        stretched = (band_array - p_low) / (p_high - p_low)
-        return stretched.clip(0,1)
-    
-    
-    def stretch_contrast(self) -> "BaseImage":
-        """Removes the outliers in a band and stretch the remaining values to increase contrast"""
-        self.individual_bands_arr = {
-            name: self._stretch_contrast(band, self.lower_percentile, self.upper_percentile, self.no_data_value)
-            for name, band in self.individual_bands_arr.items()
+    def _to_dataarray(data, attrs) -> xr.DataArray:
+        """Convert the numpy array to xarray for consistency"""
+        transform = Affine(*attrs["transform"])
+        count, height, width = data.shape
+        coords = {
+            "band": list(range(1, count + 1)),
+            "y": np.arange(height) * transform.e + transform.f,
+            "x": np.arange(width) * transform.a + transform.c
         }
 
+        return xr.DataArray(
+            data,
+            dims=("band", "y", "x"),
+            coords=coords,
+            attrs={**attrs, "transform": transform, "res": tuple(attrs["res"])}
+        )
+
+
+    def stretch_contrast(self, band_order:List, lower=2, upper=98, gamma=1.0, percentiles=None) -> "BaseImage":
+        """Removes the outliers in the bands and stretches the rest into one uint8 stack in a single pass per band.
+
+        Pass `percentiles` from :func:`eo.stretch.shared_percentiles` to stretch a time series the same way.
+        """
+        try:
+            bands = [self.individual_bands_arr[band] for band in band_order]
+        except KeyError as e:
+            raise ValueError(f"Band {e} not found in provided bands.") from e
+
+        with span('stretch', image_id=self.image_item.id):
+            stretched = stretch_bands(
+                [band.values[0] for band in bands], lower, upper, gamma=gamma,
+                nodata=bands[0].attrs.get('nodata') or 0, percentiles=percentiles
+            )
+        self._rgb_stack = xr.DataArray(
+            stretched,
+            dims=("band", "y", "x"),
+            coords={"band": list(range(1, len(bands) + 1)), "y": bands[0].y, "x": bands[0].x},
+            attrs={**bands[0].attrs, "nodata": 0}
+        )
+
         return self
     
 
@@ -130,7 +256,7 @@ class BaseImage:
 
     def get_rgb_stack(self, export:Union[bool, AnyStr, None]) -> xr.DataArray:
         if self._rgb_stack is None:
-            raise ValueError('No RGB stack. Use stack_bands() first.')
+            raise ValueError('No RGB stack. Use stack_bands() or stretch_contrast() first.')
         
         if export:
             self._rgb_stack.rio.to_raster(export, compress="deflate", lock=False, tiled=True)
@@ -139,17 +265,6 @@ class BaseImage:
         return self._rgb_stack
     
 
-    def process_stack(self, max_val, gamma, type, chunk) -> "BaseImage":
-        gamma_corrected = self._rgb_stack ** (1/gamma)
-        asuint8 = (gamma_corrected.clip(0,1) * max_val).astype(type)
-        ordered = asuint8.assign_coords(band=[1, 2, 3])
-        ordered.rio.write_crs(self.individual_bands_arr['red'].rio.crs, inplace=False)
-        chunked = ordered.chunk({'band': -1, 'y': chunk, 'x': chunk})
-        self._rgb_stack = chunked
-
-        return self
-    
-    
     @property
     def extent(self) -> box:
         """Extent of the assets: bands and true color"""
@@ -172,37 +287,54 @@ class BaseImage:
         # (569533.9820448935, 1444152.1070559227, 589533.9820448935, 1464152.1070559227) vs
         # (569538.9820448935, 1444147.1070559227, 589538.9820448935, 1464147.1070559227)
 
-    # TODO Include payload in zip
-    def export(self, out_dir, export_rgb=False, to_zip=False, runtime=None):
-        out_file = f"{out_dir}/{self.image_item.id}.tif"
-        if export_rgb: # Exports Red, Green, Blue, and True Color
-            for name, xarr in self.individual_bands_arr.items():
-                band_out_file = out_file.replace('.tif', f'_{name}.tif')
-                if to_zip:
-                    out_zip = self.to_zip(
-                        raster_xarray=xarr,
-                        filename = f"{self.image_item.id}_{name}.tif",
-                        out_zip=f"{out_dir}/{runtime}.zip"
-                    )
-                else:
-                    if name == 'visual':
-                        xarr.rio.to_raster(band_out_file, compress="deflate", lock=False, tiled=True)
-            
-            return out_zip
+    def get_output_rasters(self, export_rgb=False) -> Dict[str, xr.DataArray]:
+        """Output filename and raster pairs, Red, Green, Blue, and True Color if `export_rgb`"""
+        if export_rgb:
+            return {
+                f"{self.image_item.id}_{name}.tif": xarr
+                for name, xarr in self.individual_bands_arr.items()
+            }
 
-        else:
-            if to_zip:
-                out_zip = self.to_zip(
-                    raster_xarray=self.true_color,
-                    filename = f"{self.image_item.id}.tif",
-                    out_zip=f"{out_dir}/{runtime}.zip"
-                )
-                return out_zip
+        return {f"{self.image_item.id}.tif": self.true_color}
+
+    # TODO Include payload in zip
+    def export(self, out_dir, export_rgb=False, archive=None):
+        """Write the outputs as GeoTIFFs to out_dir, or stream them into an open :class:`JobArchive`. Returns the files written."""
+        out_files = []
+        for filename, xarr in self.get_output_rasters(export_rgb).items():
+            if archive is not None:
+                with self.encode(xarr) as memfile:
+                    out_file = archive.write(filename, memfile)
             else:
-                self.true_color.rio.to_raster(out_file, compress="deflate", lock=False, tiled=True)
+                out_file = f"{out_dir}/{filename}"
+                xarr.rio.to_raster(out_file, compress="deflate", lock=False, tiled=True)
+            out_files.append(out_file)
+
+        return out_files
+
+    def render(self, export_rgb=False) -> List[tuple]:
+        """Encode the outputs as GeoTIFFs and return a list of filename and bytes pairs, e.g. to return from a process pool"""
+        rendered = []
+        for filename, xarr in self.get_output_rasters(export_rgb).items():
+            with self.encode(xarr) as memfile:
+                rendered.append((filename, memfile.read()))
+
+        return rendered
+
+    @staticmethod
+    @contextmanager
+    def encode(raster_xarray):
+        """Yields the raster as a deflate-compressed, tiled GeoTIFF in a MemoryFile positioned at the start"""
+        with MemoryFile() as memfile:
+            with span('encode', format='GTiff'):
+                raster_xarray.rio.to_raster(memfile.name, compress="deflate", tiled=True)
+            memfile.seek(0)
+            yield memfile
 
     @staticmethod
     def memrast_to_s3(raster_xarray, s3_path:str, s3_config:Dict): # TODO This will not work with all since I have to create a URL for each of the object
+        from osgeo import gdal # Only needed here, and slow to import
+
         gdal.SetConfigOption('AWS_REGION', s3_config.get('AWS_REGION'))
         gdal.SetConfigOption('AWS_SECRET_ACCESS_KEY', s3_config.get('AWS_SECRET_ACCESS_KEY'))
         gdal.SetConfigOption('AWS_ACCESS_KEY_ID', s3_config.get('AWS_ACCESS_KEY_ID'))
@@ -221,14 +353,5 @@ class BaseImage:
 
     @staticmethod
     def to_zip(raster_xarray, filename, out_zip):
-        if Path(out_zip).exists:
-            mode = 'a'
-        else:
-            mode = 'w'
-        with zipfile.ZipFile(out_zip, mode=mode, compression=zipfile.ZIP_DEFLATED) as zf:
-            with MemoryFile() as memfile:
-                raster_xarray.rio.to_raster(memfile.name)
-                with memfile.open():
-                    mem_bytes = memfile.read()
-                    zf.writestr(filename, mem_bytes)
-        return Path(out_zip).resolve()
\ No newline at end of file
+        with JobArchive(out_zip) as archive, BaseImage.encode(raster_xarray) as memfile:
+            return archive.write(filename, memfile)
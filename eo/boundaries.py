@@ -0,0 +1,67 @@
+import threading
+import geopandas as gpd
+from functools import lru_cache
+from shapely.geometry import box
+from typing import Dict
+from eo.utils import list_intersecting_municipalities
+
+MUNICIPALITIES_CACHE_SIZE = 256
+
+
+class BoundaryLayer:
+    """Administrative boundaries read once per process and reprojected once per CRS.
+
+    Each reprojected copy keeps its spatial index so an image only touches the
+    boundaries whose bounding boxes intersect its extent.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._gdf = None
+        self._by_crs: Dict[str, gpd.GeoDataFrame] = {}
+        self._lock = threading.Lock()
+
+
+    @property
+    def gdf(self) -> gpd.GeoDataFrame:
+        with self._lock:
+            if self._gdf is None:
+                self._gdf = gpd.read_file(self.path)
+
+        return self._gdf
+
+
+    def to_crs(self, crs) -> gpd.GeoDataFrame:
+        """Returns the boundaries in `crs` with their spatial index built"""
+        key = str(crs)
+        if key not in self._by_crs:
+            reprojected = self.gdf.to_crs(key)
+            reprojected.sindex # Build the STRtree once instead of on the first query
+            with self._lock:
+                self._by_crs.setdefault(key, reprojected)
+
+        return self._by_crs[key]
+
+
+    def intersecting(self, extent: box, crs) -> gpd.GeoDataFrame:
+        """Returns the boundaries clipped to the extent, filtered by bbox through the spatial index first"""
+        layer = self.to_crs(crs)
+        candidates = layer.iloc[layer.sindex.query(extent, predicate='intersects')]
+
+        return candidates.clip(extent)
+
+
+    def municipalities(self, extent: box, crs) -> Dict:
+        """Memoized :func:`eo.utils.list_intersecting_municipalities` of the boundaries within the extent"""
+        return self._municipalities(str(crs), tuple(round(bound, 3) for bound in extent.bounds))
+
+
+    # NOTE Bounded since every AOI adds an entry for the life of the worker
+    @lru_cache(maxsize=MUNICIPALITIES_CACHE_SIZE)
+    def _municipalities(self, crs:str, bounds:tuple) -> Dict:
+        return list_intersecting_municipalities(self.intersecting(box(*bounds), crs))
+
+
+@lru_cache(maxsize=None)
+def get_boundary_layer(path) -> BoundaryLayer:
+    """Returns the process-wide :class:`BoundaryLayer` of a GeoPackage"""
+    return BoundaryLayer(path)
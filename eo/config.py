@@ -0,0 +1,11 @@
+import yaml
+from functools import lru_cache
+from pathlib import Path
+from . import PROJECT_DIR
+
+
+@lru_cache(maxsize=None)
+def get_config(path:Path = PROJECT_DIR / 'data/config.yaml') -> dict:
+    """data/config.yaml, read once per process on first use"""
+    with open(path, "r") as f:
+        return yaml.safe_load(f)
@@ -4,6 +4,11 @@ FREQUENCY_MAP = {
     'yearly': 'YE'
 }
 
+COMPOSITE_METHODS = [
+    'median', # Median of the clear observations
+    'best',   # Pixel from the least cloudy image that is clear there
+]
+
 REQUIRED_PARAMETERS = [
     'start_date',
     'end_date',
@@ -15,4 +20,28 @@ REQUIRED_PARAMETERS = [
     'boundary',
     'export_all',
     'to_zip'
-]
\ No newline at end of file
+]
+
+# Spectral indices and the eo:bands common names of their inputs, in the order of the formula
+INDEX_BANDS = {
+    'ndvi': ('nir', 'red'),
+    'ndwi': ('green', 'nir'), # McFeeters, open water
+    'nbr': ('nir', 'swir22'),
+}
+
+# Assets each output reads, by asset key or eo:bands common name
+OUTPUT_BANDS = {
+    'visual': ['visual'],
+    'export_all': ['red', 'green', 'blue', 'visual'],
+}
+
+# Sentinel-2 scene classification (SCL) values, see https://sentiwiki.copernicus.eu/web/s2-processing
+SCL_BAND = 'SCL'
+SCL_RESOLUTION = 20 # Meters
+SCL_NODATA = 0
+SCL_CLOUD_CLASSES = [
+    3,  # Cloud shadows
+    8,  # Cloud medium probability
+    9,  # Cloud high probability
+    10, # Thin cirrus
+]
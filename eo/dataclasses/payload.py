@@ -1,5 +1,9 @@
 from dataclasses import dataclass, fields, asdict
-from eo.constants import REQUIRED_PARAMETERS, FREQUENCY_MAP
+from eo.config import get_config
+from eo.constants import REQUIRED_PARAMETERS, FREQUENCY_MAP, COMPOSITE_METHODS, INDEX_BANDS
+
+MAX_WORKERS = get_config()['processing']['max_workers']
+MAX_BUFFER = get_config()['processing']['max_buffer_km']
 
 @dataclass(frozen=True)
 class Payload:
@@ -13,6 +17,12 @@ class Payload:
     boundary: bool
     export_all: bool
     to_zip: bool = True
+    workers: int = 1
+    aoi_cloud: bool = False
+    composite: str | bool = False
+    index: str | bool = False
+    animation: bool = False
+    max_side: int | bool = False
 
 required_parameters = [field.name for field in fields(Payload)]
 
@@ -35,6 +45,19 @@ def validate_payload(data):
         data['frequency'] = False
     elif data.get('frequency') not in FREQUENCY_MAP.keys():
         raise InvalidFrequencyError(message='Invalid frequency')
+
+    if data.get('composite') in ('', None):
+        data['composite'] = False
+    elif data.get('composite') not in [False, *COMPOSITE_METHODS]:
+        raise InvalidPayloadError(message='Invalid composite method')
+
+    if data.get('max_side') in ('', None):
+        data['max_side'] = False
+
+    if data.get('index') in ('', None):
+        data['index'] = False
+    elif data.get('index') not in [False, *INDEX_BANDS]:
+        raise InvalidPayloadError(message='Invalid spectral index')
     
     for key in data:
         if key not in required_parameters:
@@ -43,6 +66,29 @@ def validate_payload(data):
         if data.get(key) == '':
             raise InvalidPayloadError(message='Invalid payload: blank value/s')
         
+    try:
+        buffer = float(data.get('buffer'))
+    except (TypeError, ValueError):
+        raise InvalidPayloadError(message='Invalid payload: buffer must be a number')
+    if MAX_BUFFER and buffer > MAX_BUFFER:
+        raise InvalidPayloadError(message=f'Buffer is above the maximum of {MAX_BUFFER} km')
+
+    max_side = data.get('max_side', False)
+    if max_side is not False:
+        try:
+            max_side = int(max_side)
+        except (TypeError, ValueError):
+            raise InvalidPayloadError(message='Invalid payload: max_side must be an integer')
+        if max_side < 1:
+            raise InvalidPayloadError(message='Invalid payload: max_side must be at least 1')
+
+    try:
+        workers = int(data.get('workers', 1))
+    except (TypeError, ValueError):
+        raise InvalidPayloadError(message='Invalid payload: workers must be an integer')
+    if workers < 1:
+        raise InvalidPayloadError(message='Invalid payload: workers must be at least 1')
+
     _on_as_bool = lambda value: True if value == 'on' else value
         
     return asdict(Payload(
@@ -56,5 +102,11 @@ def validate_payload(data):
         annotate = _on_as_bool(data.get('annotate', False)),
         boundary = _on_as_bool(data.get('boundary', False)),
         export_all = _on_as_bool(data.get('export_all', False)),
-        to_zip = data.get('to_zip', True)
+        to_zip = data.get('to_zip', True),
+        workers = min(workers, MAX_WORKERS),
+        aoi_cloud = _on_as_bool(data.get('aoi_cloud', False)),
+        composite = data.get('composite', False),
+        index = data.get('index', False),
+        animation = _on_as_bool(data.get('animation', False)),
+        max_side = max_side
     ))
\ No newline at end of file
@@ -0,0 +1,8 @@
+from dataclasses import dataclass
+from typing import Callable, Tuple
+
+@dataclass(frozen=True)
+class SpectralIndex:
+    name:str
+    bands:Tuple[str, ...] # Common names or asset keys, in the order formula takes them
+    formula:Callable
@@ -0,0 +1,90 @@
+import io
+import struct
+from typing import BinaryIO
+from PIL import Image
+
+# NOTE Pillow's save_all=True keeps every frame in memory until the file is written. Here each frame
+#  is encoded on its own as a single-frame GIF and its image block is spliced into the output with
+#  its palette as a local color table, so only the frame being written is ever held.
+NETSCAPE_LOOP = b'\x21\xff\x0bNETSCAPE2.0\x03\x01%s\x00'
+
+
+def _skip_sub_blocks(data: bytes, pos: int) -> int:
+    while data[pos]:
+        pos += data[pos] + 1
+    return pos + 1
+
+
+def _split_frame(data: bytes) -> tuple:
+    """Palette, image descriptor and LZW data of a single-frame GIF"""
+    packed = data[10]
+    pos = 13
+    palette = b''
+    if packed & 0x80:
+        palette = data[pos:pos + 3 * 2 ** ((packed & 0x07) + 1)]
+        pos += len(palette)
+
+    while data[pos] != 0x2c:
+        if data[pos] != 0x21:
+            raise ValueError('Unexpected GIF block')
+        pos = _skip_sub_blocks(data, pos + 2)
+
+    descriptor = data[pos:pos + 10]
+    pos += 10
+    if descriptor[9] & 0x80:
+        palette = data[pos:pos + 3 * 2 ** ((descriptor[9] & 0x07) + 1)]
+        pos += len(palette)
+
+    start = pos
+    pos = _skip_sub_blocks(data, pos + 1) # LZW minimum code size, then the sub-blocks
+
+    return palette, descriptor, data[start:pos]
+
+
+class GifWriter:
+    """Animated GIF written to a file object one frame at a time"""
+    def __init__(self, fileobj: BinaryIO, duration_ms: int = 500, loop: int = 0, colors: int = 256):
+        self.fileobj = fileobj
+        self.delay = max(1, round(duration_ms / 10)) # Centiseconds
+        self.loop = loop
+        self.colors = colors
+        self.size = None
+        self.frames = 0
+
+
+    def append(self, frame: Image.Image):
+        if self.size is None:
+            self.size = frame.size
+            # Logical screen without a global color table, every frame brings its own palette
+            self.fileobj.write(b'GIF89a' + struct.pack('<HHBBB', *self.size, 0x70, 0, 0))
+            self.fileobj.write(NETSCAPE_LOOP % struct.pack('<H', self.loop))
+        elif frame.size != self.size:
+            raise ValueError(f'Frame size {frame.size} differs from the first frame {self.size}')
+
+        if frame.mode != 'P':
+            frame = frame.convert('RGB').quantize(colors=self.colors, method=Image.Quantize.MEDIANCUT)
+
+        encoded = io.BytesIO()
+        frame.save(encoded, format='GIF', optimize=False)
+        palette, descriptor, image_data = _split_frame(encoded.getvalue())
+
+        size_bits = max(0, (len(palette) // 3 - 1).bit_length() - 1)
+        palette = palette.ljust(3 * 2 ** (size_bits + 1), b'\x00')
+
+        # Graphic control extension: no disposal, delay, no transparency
+        self.fileobj.write(b'\x21\xf9\x04\x04' + struct.pack('<H', self.delay) + b'\x00\x00')
+        interlaced = descriptor[9] & 0x40
+        self.fileobj.write(descriptor[:9] + bytes([0x80 | interlaced | size_bits]) + palette + image_data)
+        self.frames += 1
+
+
+    def close(self):
+        self.fileobj.write(b'\x3b')
+
+
+    def __enter__(self) -> "GifWriter":
+        return self
+
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -1,36 +1,239 @@
 import pystac
 import pystac_client
+import shapely
 import planetary_computer
 import pandas as pd
-import duckdb
+import numpy as np
 import requests
+import json
+import math
+import hashlib
+import threading
+import time
+from dataclasses import asdict
+from functools import lru_cache
+from pyproj import Transformer
 from pathlib import Path
-from shapely.geometry import box
+from shapely.geometry import box, shape
+from shapely.ops import transform
 from eo.dataclasses.base_image_collection import BaseImageCollection
-from eo.constants import FREQUENCY_MAP
-from typing import List
+from eo.telemetry import span
+from eo.window_cache import strip_signature
+from eo.constants import FREQUENCY_MAP, OUTPUT_BANDS, SCL_NODATA, SCL_CLOUD_CLASSES
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+from typing import Dict, List, Union
 
-def search_catalog(imgcol: BaseImageCollection) -> pystac.item.Item:
+
+def unsign_items(items: pystac.ItemCollection) -> Dict:
+    """The item collection as a dict with the SAS tokens stripped from the asset hrefs, e.g. to store or send it"""
+    collection = items.to_dict()
+    for feature in collection['features']:
+        for asset in feature['assets'].values():
+            asset['href'] = strip_signature(asset['href'])
+
+    return collection
+
+
+def sign_items(collection: Dict) -> pystac.ItemCollection:
+    """The item collection of :func:`unsign_items` with fresh SAS tokens"""
+    return planetary_computer.sign(pystac.ItemCollection.from_dict(collection))
+
+
+class SearchCache:
+    """TTL cache of STAC search results keyed on a :class:`BaseImageCollection`.
+
+    Entries live in memory and, if ``cache_dir`` is set, as JSON item collections on disk
+    so repeat jobs for the same AOI/date range skip the catalog even after a worker restart.
+    Items are written to disk without their SAS tokens and signed again when loaded.
+    Every put drops the expired entries, then the oldest ones past `max_entries`.
+    """
+    def __init__(self, ttl:float = 1800, cache_dir:Union[str, Path, None] = None, max_entries:int = 256):
+        self.ttl = ttl
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: Dict[BaseImageCollection, tuple] = {}
+        self._lock = threading.Lock()
+
+        if self.cache_dir:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+
+    def _disk_path(self, imgcol: BaseImageCollection) -> Path:
+        key = json.dumps(asdict(imgcol), sort_keys=True)
+        return self.cache_dir / f"{hashlib.sha1(key.encode()).hexdigest()}.json"
+
+
+    def get(self, imgcol: BaseImageCollection) -> Union[pystac.ItemCollection, None]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(imgcol)
+            if entry and now - entry[0] < self.ttl:
+                self.hits += 1
+                return entry[1]
+            self._entries.pop(imgcol, None)
+
+        if self.cache_dir:
+            path = self._disk_path(imgcol)
+            try:
+                mtime = path.stat().st_mtime
+                if now - mtime < self.ttl:
+                    with open(path, 'r') as f:
+                        items = sign_items(json.load(f))
+                    with self._lock:
+                        self._entries[imgcol] = (mtime, items)
+                        self.hits += 1
+                    return items
+            except FileNotFoundError: # Not cached, or evicted by another worker
+                pass
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+
+    def put(self, imgcol: BaseImageCollection, items: pystac.ItemCollection):
+        with self._lock:
+            self._entries[imgcol] = (time.time(), items)
+
+        if self.cache_dir:
+            path = self._disk_path(imgcol)
+            tmp_path = path.with_suffix(f'.{threading.get_ident()}.tmp')
+            with open(tmp_path, 'w') as f:
+                json.dump(unsign_items(items), f)
+            tmp_path.replace(path) # Atomic so concurrent workers never read a half-written file
+
+        self.evict_expired()
+
+
+    def evict_expired(self):
+        """Drop entries older than the TTL from memory and disk, then the oldest past `max_entries`"""
+        now = time.time()
+        with self._lock:
+            for key in [k for k, (ts, _) in self._entries.items() if now - ts >= self.ttl]:
+                del self._entries[key]
+            excess = len(self._entries) - self.max_entries
+            for key in sorted(self._entries, key=lambda k: self._entries[k][0])[:max(0, excess)]:
+                del self._entries[key]
+
+        if self.cache_dir:
+            files = []
+            for path in self.cache_dir.glob('*.json'):
+                try:
+                    files.append((path, path.stat().st_mtime))
+                except FileNotFoundError:
+                    continue
+
+            files.sort(key=lambda file: file[1])
+            for position, (path, mtime) in enumerate(files):
+                if now - mtime >= self.ttl or position < len(files) - self.max_entries:
+                    path.unlink(missing_ok=True) # Another worker may have evicted it first
+
+
+    @property
+    def stats(self) -> Dict:
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+
+def search_catalog(imgcol: BaseImageCollection, cache: SearchCache = None) -> pystac.item_collection.ItemCollection:
     """Search a collection e.g. Sentintel 2 based on XY and date range."""
+    if cache is not None:
+        cached = cache.get(imgcol)
+        if cached is not None:
+            return cached
+
     date_range = f'{imgcol.start_date}/{imgcol.end_date}'
     xy = {
         'type': 'Point',
         'coordinates': [imgcol.lon, imgcol.lat]
     }
 
+    with span('search', collection=imgcol.collection) as record:
+        items = _search(imgcol.collection, xy, date_range)
+        record['items'] = len(items)
+
+    if cache is not None:
+        cache.put(imgcol, items)
+
+    return items
+
+
+def _search(collection, geometry, date_range) -> pystac.item_collection.ItemCollection:
     catalog = pystac_client.Client.open(
-        "https://planetarycomputer.microsoft.com/api/stac/v1",
+        STAC_API_URL,
         modifier=planetary_computer.sign_inplace
     )
 
     search = catalog.search(
-        collections=[imgcol.collection],
-        intersects=xy,
+        collections=[collection],
+        intersects=geometry,
         datetime=date_range
     )
 
     return search.item_collection()
 
+
+def group_date_ranges(starts, ends) -> List[List[int]]:
+    """Positions of the [start, end) ranges grouped into chains of overlapping ranges, e.g. one group per season"""
+    groups, group_end = [], None
+    for position in np.argsort(starts, kind='stable').tolist():
+        if groups and starts[position] <= group_end:
+            groups[-1].append(position)
+            group_end = max(group_end, ends[position])
+        else:
+            groups.append([position])
+            group_end = ends[position]
+
+    return groups
+
+
+def search_catalog_batch(imgcols: List[BaseImageCollection], cache: SearchCache = None) -> List[pystac.item_collection.ItemCollection]:
+    """Search many XY and date ranges with one request per collection and group of overlapping date ranges,
+    a MultiPoint over the group's date span. AOIs with disjoint dates, e.g. two different years, are searched
+    apart so neither pulls in the scenes of the dates in between.
+
+    The results are split back per image collection by footprint and date. Image collections in `cache` are
+    not searched again, and the results are cached like :func:`search_catalog` if it is given.
+    """
+    results = [cache.get(imgcol) if cache is not None else None for imgcol in imgcols]
+    missing = [i for i, items in enumerate(results) if items is None]
+
+    for collection in {imgcols[i].collection for i in missing}:
+        in_collection = [i for i in missing if imgcols[i].collection == collection]
+        all_starts = pd.to_datetime([imgcols[i].start_date for i in in_collection], utc=True).values
+        # Date-only end dates cover the whole day, like the catalog's own datetime parameter
+        all_ends = pd.to_datetime([imgcols[i].end_date for i in in_collection], utc=True).values
+        all_ends = np.where(all_ends == all_ends.astype('datetime64[D]'), all_ends + np.timedelta64(1, 'D'), all_ends)
+
+        for group in group_date_ranges(all_starts, all_ends):
+            members = [in_collection[position] for position in group]
+            starts, ends = all_starts[group], all_ends[group]
+            xs = np.array([float(imgcols[i].lon) for i in members])
+            ys = np.array([float(imgcols[i].lat) for i in members])
+
+            multipoint = {
+                'type': 'MultiPoint',
+                'coordinates': [[x, y] for x, y in set(zip(xs.tolist(), ys.tolist()))]
+            }
+            date_range = f'{min(imgcols[i].start_date for i in members)}/{max(imgcols[i].end_date for i in members)}'
+            with span('search', collection=collection, aois=len(members)) as record:
+                items = list(_search(collection, multipoint, date_range))
+                record['items'] = len(items)
+
+            # (items, members) masks of which item covers which AOI within its date range
+            datetimes = pd.to_datetime([item.properties['datetime'] for item in items], utc=True).values
+            covers = np.array([shapely.contains_xy(shape(item.geometry), xs, ys) for item in items], dtype=bool).reshape(len(items), len(members))
+            covers &= (datetimes[:, None] >= starts) & (datetimes[:, None] < ends)
+
+            for j, i in enumerate(members):
+                results[i] = pystac.ItemCollection([items[k] for k in np.flatnonzero(covers[:, j])])
+                if cache is not None:
+                    cache.put(imgcols[i], results[i])
+
+    return results
+
 def get_best_image(image_selection) -> pystac.item.Item:
     """Selects the image with the lowest cloud cover from the image collection."""
     best_image = min(image_selection, key=lambda item: item.properties["eo:cloud_cover"])
@@ -38,71 +241,293 @@ def get_best_image(image_selection) -> pystac.item.Item:
     return best_image
 
 
+def get_selection_table(image_selection) -> Dict[str, np.ndarray]:
+    """Pull the properties used for selection into arrays aligned with the items' order"""
+    items = list(image_selection)
+    properties = [item.properties for item in items]
+
+    return {
+        'datetime': pd.to_datetime([p['datetime'] for p in properties], utc=True).values,
+        'cloud_cover': np.array([p['eo:cloud_cover'] for p in properties], dtype=np.float64),
+        'mgrs_tile': np.array([p.get('s2:mgrs_tile', '') for p in properties], dtype=object),
+        # Tiles cut from the same acquisition share a datatake, older items only share the datetime
+        'datatake': np.array([p.get('s2:datatake_id', p['datetime']) for p in properties], dtype=object),
+    }
+
+
+def get_period_keys(datetimes: np.ndarray, frequency='yearly') -> np.ndarray:
+    """Returns an integer key per datetime that is the same for all datetimes in a month/quarter/year"""
+    alias = FREQUENCY_MAP.get(frequency)
+    months = datetimes.astype('datetime64[M]').astype(np.int64) # Months since 1970-01
+
+    if alias == 'ME':
+        return months
+    if alias == 'QE':
+        return months // 3
+    if alias == 'YE':
+        return months // 12
+
+    raise ValueError(f'Invalid frequency: {frequency}')
+
+
+def group_by_period(table: Dict[str, np.ndarray], frequency='yearly') -> List[np.ndarray]:
+    """Returns the item indices of each period in chronological order, least cloudy first within a period"""
+    if len(table['cloud_cover']) == 0:
+        return []
+
+    keys = get_period_keys(table['datetime'], frequency)
+    # Cloud cover ties go to the earliest image, then the catalog's order, like the pd.Grouper/idxmin it replaced
+    order = np.lexsort((table['datetime'], table['cloud_cover'], keys))
+    boundaries = np.flatnonzero(np.diff(keys[order])) + 1
+
+    return np.split(order, boundaries)
+
+
 def get_best_images(image_selection, frequency='yearly') -> pystac.item_collection.ItemCollection:
     """Selects the image with the lowest cloud cover per month from the image collection."""
-    ic = pystac.item_collection
-    temp_df = pd.DataFrame([result.to_dict() for result in image_selection]) 
-    frequency = FREQUENCY_MAP.get(frequency)
+    items = list(image_selection)
+    table = get_selection_table(items)
+    best_indices = [group[0] for group in group_by_period(table, frequency)]
 
-    capture_date = temp_df.properties.str['datetime'].rename('capture_date') # Unnest capture date and cloud cover inside 'properties'
-    cloud_cover = temp_df.properties.str['eo:cloud_cover'].rename('cloud_cover')
+    return pystac.ItemCollection([items[i] for i in best_indices])
 
-    add_cols = pd.concat([capture_date, cloud_cover], axis=1)
-    add_cols_df = pd.DataFrame(add_cols) # Create a DF of the two columns
-    add_cols_df['capture_date'] = pd.to_datetime(add_cols_df['capture_date'])
-    concat_dfs = pd.concat([temp_df, add_cols_df], axis=1) # Add back the created DF to the original DF 
 
-    best_images_df = concat_dfs.loc[ # Group by month and get the item with lowest cloud cover
-        concat_dfs.groupby(pd.Grouper(key='capture_date', axis=0, freq=frequency)).cloud_cover.idxmin()
-    ]
-    best_images_ids = best_images_df['id'].to_list()
+def get_cloud_fraction(scl: np.ndarray) -> float:
+    """Fraction of the valid pixels of an SCL window that are cloud, cirrus or cloud shadow, 1 if none are valid"""
+    valid = scl != SCL_NODATA
+    if not valid.any():
+        return 1.0
 
-    best_images = [
-        item
-        for item in image_selection
-        if any(item.id in image_id for image_id in best_images_ids)
-    ]
+    return float(np.isin(scl[valid], SCL_CLOUD_CLASSES).mean())
 
-    return ic.ItemCollection(best_images)
+
+def select_by_score(candidates: List[pystac.Item], score: Callable, workers:int = 1,
+                    good_enough:float = 0.0, max_candidates:int = 10) -> tuple:
+    """Returns the candidate with the lowest score and its score, e.g. AOI cloud fraction.
+
+    Candidates should be ordered from most to least promising (e.g. by scene cloud cover). They are
+    scored `workers` at a time and the search stops at the first batch that has a score at or below
+    `good_enough`, so a clear AOI costs one batch of reads instead of one per candidate.
+    """
+    best, best_score = None, None
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for start in range(0, min(len(candidates), max_candidates), max(1, workers)):
+            batch = candidates[start:start + max(1, workers)]
+            for item, item_score in zip(batch, pool.map(score, batch)):
+                if best_score is None or item_score < best_score:
+                    best, best_score = item, item_score
+
+            if best_score <= good_enough:
+                break
+
+    return best, best_score
+
+
+def get_best_images_by_score(image_selection, score: Callable, frequency=None, **kwargs) -> List[tuple]:
+    """Like :func:`get_best_image`/:func:`get_best_images` but ranks each period's candidates with `score`.
+
+    Returns (item, score) pairs, one per period or a single pair if `frequency` is falsy.
+    """
+    items = list(image_selection)
+    table = get_selection_table(items)
+
+    if frequency:
+        groups = group_by_period(table, frequency)
+    else:
+        groups = [np.argsort(table['cloud_cover'], kind='stable')]
+
+    return [select_by_score([items[i] for i in group], score, **kwargs) for group in groups if len(group)]
+
+
+@lru_cache(maxsize=None)
+def get_transformer(source_crs:int, target_crs:int) -> Transformer:
+    """Returns a cached always_xy transformer between two EPSG codes"""
+    return Transformer.from_crs(f'EPSG:{source_crs}', f'EPSG:{target_crs}', always_xy=True)
+
+
+def get_utm_epsg(x:float, y:float) -> int:
+    """Returns the WGS 84 UTM zone EPSG code of a lon/lat"""
+    zone = int((x + 180) // 6) % 60 + 1
+    return (32600 if y >= 0 else 32700) + zone
+
+
+def get_item_epsg(item: pystac.Item) -> Union[int, None]:
+    """Returns the EPSG code of an item's assets from the projection extension"""
+    epsg = item.properties.get('proj:epsg')
+    if epsg is None and str(item.properties.get('proj:code', '')).startswith('EPSG:'):
+        epsg = item.properties['proj:code'].split(':')[1]
+
+    return int(epsg) if epsg is not None else None
+
+
+def get_bboxes_from_points(xs, ys, source_crs:int, target_crs:int, bbox_size:float) -> np.ndarray:
+    """Return an (n, 4) array of xmin, ymin, xmax, ymax of the buffer's bounding box around each point"""
+    tx, ty = get_transformer(source_crs, target_crs).transform(
+        np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64)
+    )
+
+    return np.column_stack([tx - bbox_size, ty - bbox_size, tx + bbox_size, ty + bbox_size])
 
 
 def get_bbox_from_point(x:float, y:float, source_crs:int, target_crs:int, bbox_size:int) -> box:
     """Return a shapely box created from the minimum and maximum XY of the bounding box of the buffer from the given point"""
-    conn = duckdb.connect()
-
-    query = f"""
-        INSTALL spatial; LOAD spatial;
-
-        WITH geom AS (
-            SELECT 
-                ST_Envelope(
-                    ST_Buffer(
-                        ST_Transform(
-                            ST_Point({x}, {y}), 
-                            'EPSG:{source_crs}',
-                            'EPSG:{target_crs}',
-                            always_xy := true
-                        ),
-                    {bbox_size}
-                    )
-                ) AS geom
-            )
-        SELECT 
-            ST_XMin(geom) AS xmin, 
-            ST_YMin(geom) AS ymin,
-            ST_XMax(geom) AS xmax,
-            ST_YMax(geom) AS ymax,
-        FROM geom;
+    bounds = get_bboxes_from_points([x], [y], source_crs, target_crs, bbox_size)[0]
+
+    return box(*bounds)
+
+
+def get_read_shape(bbox_size:float, resolution:float, max_side:int = None) -> Union[tuple, None]:
+    """(height, width) to read a buffer at so it is at most `max_side` pixels per side, None for full resolution.
+
+    GDAL serves a decimated read from the closest COG overview, so the bytes fetched scale with the output pixels.
     """
+    side = math.ceil(2 * bbox_size / resolution)
+    if not max_side or side <= max_side:
+        return None
+
+    return (int(max_side), int(max_side))
+
+
+def get_item_bbox(item: pystac.Item, x:float, y:float, bbox_size:float, source_crs:int = 4326) -> box:
+    """Buffer a point in the item's own UTM zone, or the point's zone if the item has no proj:epsg"""
+    target_crs = get_item_epsg(item) or get_utm_epsg(x, y)
+
+    return get_bbox_from_point(x, y, source_crs, target_crs, bbox_size)
+
+
+def get_mosaic_items(best_images, image_selection, x:float, y:float, bbox_size:float) -> Dict[str, List[pystac.Item]]:
+    """Returns, per best image id, the items of other MGRS tiles from the same acquisition that cover the part of the AOI it misses"""
+    items = list(image_selection)
+    table = get_selection_table(items)
+    mosaic_items = {}
 
-    bounds = conn.sql(query).fetchall()[0]
+    for best in best_images:
+        # The AOI in lon/lat, buffered in the item's own zone like the clip
+        epsg = get_item_epsg(best) or get_utm_epsg(x, y)
+        aoi = transform(get_transformer(epsg, 4326).transform, get_item_bbox(best, x, y, bbox_size))
+        missing = aoi.difference(shape(best.geometry))
+        if missing.is_empty:
+            continue
+
+        datatake = best.properties.get('s2:datatake_id', best.properties['datetime'])
+        candidates = np.flatnonzero(
+            (table['datatake'] == datatake) & (table['mgrs_tile'] != best.properties.get('s2:mgrs_tile', ''))
+        )
+        candidates = candidates[np.argsort(table['cloud_cover'][candidates], kind='stable')]
+
+        neighbours = []
+        for index in candidates:
+            footprint = shape(items[index].geometry)
+            if footprint.intersects(missing):
+                neighbours.append(items[index])
+                missing = missing.difference(footprint)
+            if missing.is_empty:
+                break
+
+        if neighbours:
+            mosaic_items[best.id] = neighbours
+
+    return mosaic_items
+
+
+STAC_API_URL = "https://planetarycomputer.microsoft.com/api/stac/v1"
+COLLECTION_SNAPSHOT_DIR = Path(__file__).resolve().parent / 'collections'
+
+_COLLECTION_CACHE: Dict[str, tuple] = {} # (expiry time, metadata) per collection
+_COLLECTION_CACHE_LOCK = threading.Lock()
+
+
+def _load_collection_snapshot(collection_name) -> Union[Dict, None]:
+    snapshot = COLLECTION_SNAPSHOT_DIR / f'{collection_name}.json'
+    if not snapshot.exists():
+        return None
+
+    with open(snapshot, 'r') as f:
+        return json.load(f)
 
-    return box(bounds[0], bounds[1], bounds[2], bounds[3])
 
 # NOTE See https://planetarycomputer.microsoft.com/api/stac/v1/collections/sentinel-2-l2a for reference
-def get_collection_bands(collection_name) -> List:
+def get_collection_metadata(collection_name, ttl:float = 86400, offline:bool = False, timeout:float = 5,
+                            retry_ttl:float = 60) -> Dict:
+    """Returns a collection's metadata, cached per process for `ttl` seconds.
+
+    Falls back to the last fetched copy or the bundled snapshot in eo/collections if the
+    endpoint fails or is slow. A fallback is only cached for `retry_ttl` seconds so the
+    endpoint is tried again soon. With `offline` the snapshot is used without any request.
+    """
+    now = time.time()
+    with _COLLECTION_CACHE_LOCK:
+        cached = _COLLECTION_CACHE.get(collection_name)
+    if cached and now < cached[0]:
+        return cached[1]
+
+    snapshot = _load_collection_snapshot(collection_name)
+    expires = now + ttl
+    if offline and snapshot is not None:
+        metadata = snapshot
+    else:
+        try:
+            response = requests.get(f'{STAC_API_URL}/collections/{collection_name}', timeout=timeout)
+            response.raise_for_status()
+            metadata = response.json()
+        except requests.RequestException:
+            if cached:
+                metadata = cached[1]
+            elif snapshot is not None:
+                metadata = snapshot
+            else:
+                raise
+            expires = now + retry_ttl
+
+    with _COLLECTION_CACHE_LOCK:
+        _COLLECTION_CACHE[collection_name] = (expires, metadata)
+
+    return metadata
+
+
+def get_collection_item_assets(collection_name, **kwargs) -> Dict:
+    """Returns the item_assets of a collection"""
+    return get_collection_metadata(collection_name, **kwargs)['item_assets']
+
+
+def get_band_resolutions(collection_name, **kwargs) -> Dict:
+    """Returns the ground sample distance in meters of each asset that has one"""
+    item_assets = get_collection_item_assets(collection_name, **kwargs)
+    return {band: asset['gsd'] for band, asset in item_assets.items() if 'gsd' in asset}
+
+
+def get_collection_bands(collection_name, **kwargs) -> List:
     """Returns a list of bands available for a collection"""
-    response = requests.get(f'https://planetarycomputer.microsoft.com/api/stac/v1/collections/{collection_name}')
-    response.raise_for_status()
-    item_assets = response.json()['item_assets']
-    return [band for band in item_assets if item_assets[band].get('eo:bands')]
\ No newline at end of file
+    item_assets = get_collection_item_assets(collection_name, **kwargs)
+    return [band for band in item_assets if item_assets[band].get('eo:bands')]
+
+
+def resolve_bands(names:List, item_assets:Dict) -> List:
+    """Map asset keys or common names (e.g. red) to asset keys, only single-band assets match a common name"""
+    common_names = {
+        asset['eo:bands'][0].get('common_name'): key
+        for key, asset in item_assets.items()
+        if len(asset.get('eo:bands', [])) == 1
+    }
+
+    resolved = []
+    for name in names:
+        key = name if name in item_assets else common_names.get(name)
+        if key is None:
+            raise ValueError(f"Band {name} not found in the collection's assets.")
+        if key not in resolved:
+            resolved.append(key)
+
+    return resolved
+
+
+def plan_bands(parameters:Dict, item_assets:Dict) -> List:
+    """Returns the minimal list of assets to read for the outputs requested in the payload"""
+    # Annotated PNGs only use the true color image even if export_all is set
+    if parameters.get('export_all') and not parameters.get('annotate'):
+        outputs = ['export_all']
+    else:
+        outputs = ['visual']
+
+    return resolve_bands([band for output in outputs for band in OUTPUT_BANDS[output]], item_assets)
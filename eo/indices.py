@@ -0,0 +1,68 @@
+import numpy as np
+from contextlib import contextmanager
+from rasterio.io import MemoryFile
+from typing import Dict, List
+from eo.constants import INDEX_BANDS
+from eo.dataclasses.spectral_index import SpectralIndex
+
+# Sentinel-2 L2A digital numbers to reflectance, baseline 04.00 (from 2022-01-25) adds a -1000 offset
+REFLECTANCE_SCALE = 10000
+BOA_ADD_OFFSET = -1000
+BOA_OFFSET_BASELINE = 4.0
+
+
+def normalized_difference(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (a - b) / (a + b)
+
+
+INDICES: Dict[str, SpectralIndex] = {
+    name: SpectralIndex(name, bands, normalized_difference) for name, bands in INDEX_BANDS.items()
+}
+
+
+def get_index(name) -> SpectralIndex:
+    try:
+        return INDICES[name]
+    except KeyError as e:
+        raise ValueError(f"Index {name} not found, choose from {list(INDICES)}.") from e
+
+
+def to_reflectance(data: np.ndarray, properties: Dict, nodata=0) -> np.ndarray:
+    """Returns the digital numbers as float32 reflectance with nodata as NaN.
+
+    Reflectance below 0 after the BOA offset, e.g. over dark water and shadows, is clipped to 0 so
+    normalized differences stay within [-1, 1].
+    """
+    reflectance = data.astype(np.float32)
+    reflectance[data == nodata] = np.nan
+
+    baseline = properties.get('s2:processing_baseline')
+    if baseline is not None and float(baseline) >= BOA_OFFSET_BASELINE:
+        reflectance += BOA_ADD_OFFSET
+        np.maximum(reflectance, 0, out=reflectance) # NaN stays NaN
+
+    reflectance /= REFLECTANCE_SCALE
+    return reflectance
+
+
+def compute_index(index: SpectralIndex, band_stacks: List[np.ndarray]) -> np.ndarray:
+    """Compute the index once over (time, y, x) stacks of its bands, in the order of `index.bands`"""
+    values = index.formula(*band_stacks).astype(np.float32, copy=False)
+    values[~np.isfinite(values)] = np.nan # e.g. a + b == 0 after the BOA offset
+
+    return values
+
+
+@contextmanager
+def encode_cog(data: np.ndarray, transform, crs, nodata=np.nan):
+    """Yields a single band float32 array as a tiled, deflate-compressed COG in a MemoryFile positioned at the start"""
+    with MemoryFile() as memfile:
+        with memfile.open(
+            driver='COG', height=data.shape[-2], width=data.shape[-1], count=1,
+            dtype='float32', crs=crs, transform=transform, nodata=nodata,
+            blocksize=256, compress='deflate', predictor=3 # Floating point predictor
+        ) as dst:
+            dst.write(data.reshape(1, *data.shape[-2:]))
+        memfile.seek(0)
+        yield memfile
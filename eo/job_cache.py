@@ -0,0 +1,161 @@
+import hashlib
+import json
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from stat import S_ISDIR, S_ISREG
+from typing import Dict, Union
+
+# Payload keys that change how a job runs but not what it outputs
+IGNORED_KEYS = ('workers',)
+
+
+def payload_key(validated: Dict) -> str:
+    """Canonical hash of a payload from :func:`validate_payload`, the same for the same outputs"""
+    canonical = {key: value for key, value in validated.items() if key not in IGNORED_KEYS}
+    return hashlib.sha256(json.dumps(canonical, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class JobCache:
+    """Finished jobs and jobs in flight per payload key, in Redis so the app and the workers share them.
+
+    `claim()` is a single SET NX, so of many identical submissions at the same time only one starts a
+    task and the rest get its task id. The claim expires after `lock_ttl` unless the task keeps it
+    alive with :meth:`hold`, so a task that died never keeps the payload waiting for long.
+    """
+    def __init__(self, client, ttl:float = 86400, lock_ttl:float = 300, prefix:str = 'eo:job'):
+        self.client = client
+        self.ttl = int(ttl)
+        self.lock_ttl = int(lock_ttl)
+        self.prefix = prefix
+
+
+    def _result_key(self, key) -> str:
+        return f'{self.prefix}:result:{key}'
+
+
+    def _inflight_key(self, key) -> str:
+        return f'{self.prefix}:inflight:{key}'
+
+
+    def get_result(self, key) -> Union[Dict, None]:
+        """Task id and output of the last finished job for the key, None if there is none or its output was evicted"""
+        cached = self.client.get(self._result_key(key))
+        if cached is None:
+            return None
+
+        result = json.loads(cached)
+        if not Path(result['out_file']).exists():
+            self.client.delete(self._result_key(key))
+            return None
+
+        return result
+
+
+    def claim(self, key, task_id) -> Union[str, None]:
+        """Mark `task_id` as the job running for the key. Returns the id of the job already running instead, if any."""
+        if self.client.set(self._inflight_key(key), task_id, nx=True, ex=self.lock_ttl):
+            return None
+
+        running = self.client.get(self._inflight_key(key))
+        if running is None: # Finished in between, try again
+            return self.claim(key, task_id)
+
+        return running.decode() if isinstance(running, bytes) else running
+
+
+    def finish(self, key, task_id, out_file):
+        self.client.set(self._result_key(key), json.dumps({'task_id': task_id, 'out_file': str(Path(out_file).resolve())}), ex=self.ttl)
+        self.release(key, task_id)
+
+
+    def _is_running(self, key, task_id) -> bool:
+        running = self.client.get(self._inflight_key(key))
+        return running is not None and (running.decode() if isinstance(running, bytes) else running) == task_id
+
+
+    def release(self, key, task_id):
+        """Clear the in-flight mark if it is still this task's"""
+        if self._is_running(key, task_id):
+            self.client.delete(self._inflight_key(key))
+
+
+    def heartbeat(self, key, task_id):
+        """Push back the in-flight mark's expiry if it is still this task's"""
+        if self._is_running(key, task_id):
+            self.client.expire(self._inflight_key(key), self.lock_ttl)
+
+
+    @contextmanager
+    def hold(self, key, task_id):
+        """Keep the task's claim alive while the block runs, with a heartbeat every third of `lock_ttl`"""
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(self.lock_ttl / 3):
+                self.heartbeat(key, task_id)
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+
+def _output_stat(path:Path) -> Union[tuple, None]:
+    """(mtime, bytes) of an output file, or of a task's directory of outputs by its newest file. None if it is gone."""
+    stat = path.stat()
+    if S_ISREG(stat.st_mode):
+        return stat.st_mtime, stat.st_size
+    if not S_ISDIR(stat.st_mode):
+        return None
+
+    mtime, size = stat.st_mtime, 0
+    for file in path.rglob('*'):
+        try:
+            file_stat = file.stat()
+        except FileNotFoundError:
+            continue
+        if S_ISREG(file_stat.st_mode):
+            mtime, size = max(mtime, file_stat.st_mtime), size + file_stat.st_size
+
+    return mtime, size
+
+
+def evict_outputs(directory:Union[str, Path], max_age:float, max_bytes:float) -> list:
+    """Delete outputs older than `max_age` seconds, then the oldest until the rest fit in `max_bytes`.
+
+    A task's directory of outputs is deleted as a whole, by the age of its newest file. Tasks share
+    the directory, so outputs another task deleted in the meantime are skipped.
+    """
+    now = time.time()
+    outputs = []
+    for path in Path(directory).iterdir():
+        if path.name.startswith('.'):
+            continue
+        try:
+            output_stat = _output_stat(path)
+        except FileNotFoundError:
+            continue
+        if output_stat is not None:
+            outputs.append((path, *output_stat))
+
+    outputs.sort(key=lambda output: output[1])
+    evicted = []
+    total = sum(size for _, _, size in outputs)
+
+    for path, mtime, size in outputs:
+        if now - mtime < max_age and total <= max_bytes:
+            break
+        if path.is_dir():
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            path.unlink(missing_ok=True)
+        total -= size
+        evicted.append(path)
+
+    return evicted
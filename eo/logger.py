@@ -6,7 +6,7 @@ def logger(log_file, to_console=False):
     logger = logging.getLogger('eo_logger')
     logger.setLevel(logging.DEBUG)
 
-    file_handler = logging.FileHandler(log_file, mode='w')
+    file_handler = logging.FileHandler(log_file, mode='w', delay=True) # Opened on the first record
     file_handler.setLevel(logging.DEBUG)
 
     formatter = logging.Formatter(
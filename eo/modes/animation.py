@@ -0,0 +1,94 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import numpy as np
+from PIL import Image, ImageDraw
+from eo.annotated_image import _load_font
+from eo.gif import GifWriter
+from eo.image_utils import resolve_bands, get_mosaic_items, get_item_bbox, get_item_epsg, get_utm_epsg
+from eo.stretch import shared_percentiles
+from eo.utils import simplify_datetime
+from eo.modes.basic import BasicMode, clip_image, log, CONFIG, MOSAIC
+from eo.pool import imap_ordered
+
+FRAME_SIZE = CONFIG['animation']['frame_size']
+FRAME_DURATION = CONFIG['animation']['duration_ms']
+STRETCH = CONFIG['animation']['stretch']
+
+
+def render_frame(rgb: np.ndarray, caption: str) -> Image.Image:
+    """(3, y, x) uint8 stack to an RGB frame with the caption on the top left"""
+    frame = Image.fromarray(np.moveaxis(rgb, 0, -1))
+    draw = ImageDraw.Draw(frame)
+    font = _load_font(max(12, frame.height // 30))
+    draw.text((frame.height // 60, frame.height // 60), caption, font=font, fill='white', stroke_width=2, stroke_fill='black')
+
+    return frame
+
+
+class AnimationMode(BasicMode):
+    """Animated GIF of the selected images, frames are read, stretched, quantized and appended one at a time"""
+    requires_buffer = True
+
+    def __init__(self, parameters, progress=None, out_dir=None, items=None):
+        super().__init__(parameters, progress, out_dir, items)
+        self.band_list = resolve_bands(['red', 'green', 'blue'], self.item_assets)
+
+
+    def run(self):
+        self.start_run()
+
+        latitude = self.parameters.get('latitude')
+        longitude = self.parameters.get('longitude')
+        buffer = float(self.parameters.get('buffer'))
+        workers = self.get_workers()
+
+        log.info('RUNNING IN ANIMATION MODE')
+
+        best_images = sorted(self.select_images(), key=lambda image: image.properties['datetime'])
+
+        mosaic_items = None
+        if MOSAIC:
+            mosaic_items = get_mosaic_items(best_images, self.image_selection, longitude, latitude, buffer*1000)
+
+        # Every frame is read onto the grid of the least cloudy one, decimated to the frame size instead of
+        # resized after. Frames from tiles of a neighbouring UTM zone, e.g. around 120°E, are warped onto it
+        # so they do not shift or rotate.
+        reference_item = min(best_images, key=lambda image: image.properties['eo:cloud_cover'])
+        crs = f'EPSG:{get_item_epsg(reference_item) or get_utm_epsg(longitude, latitude)}'
+        bbox = get_item_bbox(reference_item, longitude, latitude, buffer*1000)
+        resolution = min(self.item_assets[band]['gsd'] for band in self.band_list)
+        side = min(FRAME_SIZE, max(1, round(2 * buffer * 1000 / resolution)))
+        clip = partial(
+            clip_image, band_list=self.band_list, lon=longitude, lat=latitude, buffer=buffer,
+            mosaic_items=mosaic_items, out_shape=(side, side), grid=(bbox, crs)
+        )
+        log.info(f'FRAMES ON A {side}x{side} GRID IN {crs}')
+
+        # Stretch every frame with the percentiles of the least cloudy one so the colours do not flicker
+        reference = clip(reference_item)
+        percentiles = shared_percentiles(
+            [[reference.individual_bands_arr[band].values[0]] for band in self.band_list],
+            STRETCH['lower'], STRETCH['upper']
+        )
+        log.info(f'STRETCHING FRAMES WITH {reference.image_item.id} PERCENTILES: {percentiles}')
+        del reference
+
+        out_file = self.output_path(f'{self.run_name}.gif')
+
+        with ThreadPoolExecutor(max_workers=workers) as io_pool, open(out_file, 'wb') as f, \
+                GifWriter(f, duration_ms=FRAME_DURATION) as gif:
+            for index, (base_img, seconds) in enumerate(imap_ordered(io_pool, clip, best_images, prefetch=workers)):
+                render_start = time.time()
+                rgb = base_img.stretch_contrast(
+                    self.band_list, gamma=STRETCH['gamma'], percentiles=percentiles
+                ).get_rgb_stack(export=False).values
+                gif.append(render_frame(rgb, simplify_datetime(base_img.image_item.properties['datetime'])))
+                self.progress.image_done(base_img.image_item.id) # The GIF is only readable once it is closed
+
+                log.info(
+                    f'FRAME {index + 1}/{len(best_images)} {base_img.image_item.id}: '
+                    f'CLIP {round(seconds, 2)}s, RENDER {round(time.time() - render_start, 2)}s'
+                )
+
+        return self.finish_run(out_file)
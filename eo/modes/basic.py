@@ -1,19 +1,29 @@
+import multiprocessing
+import shutil
 import time
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import cached_property, partial
 from datetime import datetime
-import yaml
 from pathlib import Path
 import numpy as np
 from .. import PROJECT_DIR
 from eo.base_image import BaseImage
 from eo.dataclasses.base_image_collection import BaseImageCollection
-from eo.annotated_image import AnnotatedImage
+from eo.annotated_image import AnnotatedImage, PYPLOT_AXES_FRACTION
+from eo.archive import JobArchive
+from eo.config import get_config
 from eo.logger import logger
-from eo.image_utils import (get_best_image, get_best_images, get_bbox_from_point, 
-                            search_catalog, get_collection_bands)
-from eo.constants import REQUIRED_PARAMETERS
+from eo.pool import imap_ordered, timed
+from eo.progress import JobProgress
+from eo.telemetry import span
+from eo.window_cache import WindowCache
+from eo.image_utils import (get_best_image, get_best_images, get_item_bbox, get_mosaic_items,
+                            search_catalog, get_collection_item_assets, plan_bands, SearchCache, sign_items,
+                            get_best_images_by_score, get_cloud_fraction, get_read_shape)
+from eo.constants import REQUIRED_PARAMETERS, SCL_BAND, SCL_RESOLUTION
 
-with open(Path(PROJECT_DIR / 'data/config.yaml'), "r") as f:
-    CONFIG = yaml.safe_load(f)
+CONFIG = get_config()
 
 log = logger(PROJECT_DIR / 'logs/eo.log')
 
@@ -27,11 +37,112 @@ PROCESSED_IMG_DIR = CONFIG['processed_images_directory']
 PH_BDRYS = CONFIG['ph_boundaries_gpkg']
 FIGSIZE = CONFIG['figure_size']
 DPI = CONFIG['dpi']
+RENDERER = CONFIG['annotation_renderer']
 S2A = CONFIG['collections']['s2a']
+COLLECTION_CACHE = CONFIG['collection_cache']
+RENDER_EXECUTOR = CONFIG['processing']['render_executor']
+MAX_WORKERS = CONFIG['processing']['max_workers']
+BAND_WORKERS = CONFIG['processing']['band_workers']
+MOSAIC = CONFIG['processing']['mosaic']
+AOI_CLOUD = CONFIG['aoi_cloud']
+MAX_BUFFER = CONFIG['processing']['max_buffer_km']
+TELEMETRY = CONFIG['telemetry']
+JOB_CACHE_CONFIG = CONFIG['job_cache']
+
+SEARCH_CACHE = SearchCache(
+    ttl=CONFIG['search_cache']['ttl'],
+    cache_dir=CONFIG['search_cache'].get('directory'),
+    max_entries=CONFIG['search_cache']['max_entries']
+)
+
+WINDOW_CACHE = WindowCache(
+    cache_dir=CONFIG['window_cache']['directory'],
+    max_bytes=CONFIG['window_cache']['max_size_mb'] * 1024 ** 2
+) if CONFIG['window_cache'].get('directory') else None
+
+# NOTE The render pool is forked from a single-threaded server process instead of from the Celery
+#  worker, which has the task, read and band threads running
+RENDER_CONTEXT = multiprocessing.get_context('forkserver')
+RENDER_CONTEXT.set_forkserver_preload(['eo.modes.basic'])
+
+def clip_image(image, band_list, lon, lat, buffer, mosaic_items=None, out_shape=None, grid=None) -> BaseImage:
+    """Clip the buffer in the item's own UTM zone, or the (bbox, crs) `grid` that images of other zones are warped onto"""
+    if buffer > 0:
+        if grid is not None:
+            bbox, crs = grid
+        else:
+            with span('bbox', image_id=image.id):
+                bbox, crs = get_item_bbox(image, lon, lat, buffer*1000), None
+        return BaseImage(
+            image_item=image, band_list=band_list, bbox=bbox, crs=crs,
+            band_workers=BAND_WORKERS, window_cache=WINDOW_CACHE,
+            mosaic_items=(mosaic_items or {}).get(image.id), out_shape=out_shape
+        )
+    else:
+        return BaseImage(image_item=image, band_nums=band_list) # TODO Convert to stateless class
+
+
+def get_aoi_cloud_fraction(image, lon, lat, buffer) -> float:
+    """Cloud fraction of the AOI from the image's SCL window, at most aoi_cloud max_side pixels per side"""
+    bbox = get_item_bbox(image, lon, lat, buffer*1000)
+    out_shape = get_read_shape(buffer*1000, SCL_RESOLUTION, AOI_CLOUD['max_side'])
+    scl_img = BaseImage(
+        image_item=image, band_list=[SCL_BAND], bbox=bbox, window_cache=WINDOW_CACHE, out_shape=out_shape
+    )
+
+    return get_cloud_fraction(scl_img.individual_bands_arr[SCL_BAND].values)
+
+
+def export_image(base_img, annotate, export_all, out_dir, archive=None, **annotate_kwargs) -> list:
+    """Annotate or export a clipped image straight to the output directory or the job's archive, returns the files written"""
+    if annotate:
+        annt_img = AnnotatedImage(base_image=base_img)
+        return [annt_img.annotate(boundaries=PH_BDRYS, out_dir=out_dir, archive=archive, **annotate_kwargs)]
+
+    return base_img.export(out_dir=out_dir, export_rgb=export_all, archive=archive)
+
+
+def render_image(base_img, annotate, export_all, **annotate_kwargs) -> list:
+    """Annotate or encode a clipped image into (filename, bytes) pairs. Module-level so it can run in a process pool."""
+    if annotate:
+        annt_img = AnnotatedImage(base_image=base_img)
+        return [annt_img.render(boundaries=PH_BDRYS, **annotate_kwargs)]
+
+    return base_img.render(export_rgb=export_all)
+
+
+def write_output(filename, data, out_dir, archive=None) -> str:
+    """Write bytes or a binary file to the job's archive or to the output directory, returns the file written"""
+    if archive is not None:
+        return archive.write(filename, data)
+
+    out_file = f'{out_dir}/{filename}'
+    with open(out_file, 'wb') as f:
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            f.write(data)
+        else:
+            shutil.copyfileobj(data, f)
+
+    return out_file
+
+
+def write_entries(entries, out_dir, archive=None) -> list:
+    """Write (filename, bytes) pairs to the job's archive or to the output directory, returns the files written"""
+    return [write_output(filename, data, out_dir, archive=archive) for filename, data in entries]
+
 
 class BasicMode:
-    def __init__(self, parameters):
+    requires_buffer = False # Modes that only work on a clipped AOI
+
+    def __init__(self, parameters, progress=None, out_dir=None, items=None):
+        """`out_dir` defaults to processed_images_directory. The app gives each task a directory of its
+        own since output names only tell the images, periods and run time apart, not the AOIs.
+
+        `items` are the unsigned items of a search already made for this AOI, e.g. by a batch, see unsign_items()."""
         self.parameters = parameters
+        self.progress = progress or JobProgress()
+        self.out_dir = str(out_dir or PROCESSED_IMG_DIR)
+        Path(self.out_dir).mkdir(parents=True, exist_ok=True)
 
         self.image_collection = BaseImageCollection(
             start_date = self.parameters.get('start_date'),
@@ -41,80 +152,204 @@ class BasicMode:
             collection = S2A
         )
 
-        self.available_bands = get_collection_bands(S2A)
+        self.item_assets = get_collection_item_assets(S2A, **COLLECTION_CACHE)
+        self.band_list = plan_bands(self.parameters, self.item_assets)
+
+        if items is not None:
+            self.image_selection = sign_items(items) # Skips the search of the cached property
 
-    @property
+    @cached_property
     def image_selection(self):
-        return search_catalog(self.image_collection)
+        self.progress.set_stage('search')
+        return search_catalog(self.image_collection, cache=SEARCH_CACHE)
 
     def check_parameters(self):
         if not all([rp in self.parameters for rp in REQUIRED_PARAMETERS]):
             raise KeyError('Input parameters is incomplete')
-        
-    def run(self):
+
+        if MAX_BUFFER and float(self.parameters.get('buffer')) > MAX_BUFFER:
+            raise ValueError(f'Buffer is above the maximum of {MAX_BUFFER} km')
+
+    def start_run(self):
+        """Preamble of every mode's run(): checks and logs the payload, makes sure there are images and starts the clock"""
         self.check_parameters()
-        start_time = time.time()
-        start_time_readable = datetime.fromtimestamp(start_time).strftime("%Y%m%d_%H%M%S")
+        self.start_time = time.time()
+        self.run_name = datetime.fromtimestamp(self.start_time).strftime("%Y%m%d_%H%M%S")
 
         if len(self.image_selection) == 0:
             log.error('ZERO IMAGES FOUND BASED ON PAYLOAD')
             raise ValueError('ZERO IMAGES FOUND BASED ON PAYLOAD')
+
+        if self.requires_buffer and float(self.parameters.get('buffer')) <= 0:
+            raise ValueError(f'{type(self).__name__} needs a buffer greater than 0')
+
+        log.info(f'PAYLOAD: {self.parameters}')
+
+    def finish_run(self, out_file=None):
+        """Log the output and the run time and mark the job as done, returns `out_file`"""
+        if out_file is not None:
+            log.info(f'OUT FILE: {out_file}')
+        log.info(f"FINISHED IN {round(time.time() - self.start_time, 2)} SECONDS")
+        self.progress.set_stage('done')
+
+        return out_file
+
+    def output_path(self, filename) -> str:
+        """Where an output of the job goes when it is not zipped"""
+        return f'{self.out_dir}/{filename}'
+
+    def open_archive(self):
+        """The job's zip named after the run if the payload has to_zip, else None. Open it in a with block."""
+        return JobArchive(self.output_path(f'{self.run_name}.zip')) if self.parameters.get('to_zip') else None
+
+    def _write_output(self, filename, data, archive=None) -> str:
+        """Bytes or a binary file to the job's archive or the output directory, see :func:`write_output`"""
+        return write_output(filename, data, self.out_dir, archive=archive)
+
+    def _outputs_done(self, image_id, out_files, archive=None):
+        """Report an image's (or period's) outputs, which can be downloaded as soon as they are written, see app.routes"""
+        if archive is not None:
+            self.progress.image_done(image_id, archive.entries[-len(out_files):], archive=archive)
+        else:
+            self.progress.image_done(image_id, out_files)
+
+    def get_workers(self) -> int:
+        """The payload's workers, at least 1 and at most `processing.max_workers`. The CLI does not validate payloads."""
+        return min(max(1, int(self.parameters.get('workers') or 1)), MAX_WORKERS)
+
+    def get_read_shape(self, annotate=None) -> tuple:
+        """Read shape of the buffer for the output, None reads at native resolution. Annotated PNGs
+        (`annotate` defaults to the payload's) are read at their own size, other outputs only
+        from the overviews if the payload sets max_side."""
+        if annotate is None:
+            annotate = self.parameters.get('annotate')
+        max_side = round(FIGSIZE * DPI * PYPLOT_AXES_FRACTION) if annotate else self.parameters.get('max_side')
+
+        resolution = min(self.item_assets[band]['gsd'] for band in self.band_list)
+        return get_read_shape(float(self.parameters.get('buffer')) * 1000, resolution, max_side)
         
+    def select_images(self) -> list:
+        """The least cloudy image of the date range or of each period, by scene or AOI cloud cover.
+        Moves the job's progress on to processing them."""
+        self.progress.set_stage('selection')
+        with span('selection', candidates=len(self.image_selection)) as record:
+            best_images = self._select_images()
+            record['images'] = len(best_images)
+
+        self.progress.set_stage('processing', total=len(best_images))
+        return best_images
+
+    def _select_images(self) -> list:
         latitude = self.parameters.get('latitude')
         longitude = self.parameters.get('longitude')
         buffer = float(self.parameters.get('buffer'))
         frequency = self.parameters.get('frequency')
+
+        if self.parameters.get('aoi_cloud') and buffer > 0:
+            log.info('RANKING IMAGES BY CLOUD COVER WITHIN THE AOI')
+            score = partial(get_aoi_cloud_fraction, lon=longitude, lat=latitude, buffer=buffer)
+            best_scored = get_best_images_by_score(
+                self.image_selection, score, frequency=frequency,
+                workers=self.get_workers(), good_enough=AOI_CLOUD['good_enough'],
+                max_candidates=AOI_CLOUD['max_candidates']
+            )
+            for image, cloud_fraction in best_scored:
+                log.info(f'{image.id}: {round(cloud_fraction * 100, 1)}% AOI CLOUD COVER')
+            return [image for image, _ in best_scored]
+        elif frequency:
+            log.info('RUNNING IN MULTI MODE')
+            return list(get_best_images(self.image_selection, frequency=frequency))
+        else:
+            log.info('RUNNING IN SINGLE MODE')
+            return [get_best_image(self.image_selection)] # Put in list to be compatible with logic downstream
+
+    def run(self):
+        self.start_run()
+
+        latitude = self.parameters.get('latitude')
+        longitude = self.parameters.get('longitude')
+        buffer = float(self.parameters.get('buffer'))
         annotate = self.parameters.get('annotate')
         boundary = self.parameters.get('boundary')
         export_all = self.parameters.get('export_all')
-        to_zip = self.parameters.get('to_zip')
-        bbox = get_bbox_from_point(longitude, latitude, 4326, 32651, buffer*1000)
-        
-        log.info(f'PAYLOAD: {self.parameters}')
+
         log.info(f'GOT {len(self.image_selection)} IMAGES TO SELECT FROM')
+        log.info(f'SEARCH CACHE: {SEARCH_CACHE.stats}')
 
-        if frequency:
-            log.info('RUNNING IN MULTI MODE')
-            best_images = get_best_images(self.image_selection, frequency=frequency)
+        best_images = self.select_images()
+
+        workers = self.get_workers()
+        log.info(f'PROCESSING {len(best_images)} IMAGES WITH {workers} WORKERS')
+        log.info(f'READING BANDS: {self.band_list}')
+
+        if buffer > 0:
+            log.info(f'ONLY GETTING AREA {buffer} METERS FROM XY')
         else:
-            log.info('RUNNING IN SINGLE MODE')
-            best_images = [get_best_image(self.image_selection)] # Put in list to be compatible with logic downstream
-
-        for image in best_images:
-            if buffer > 0:
-                log.info(f'ONLY GETTING AREA {buffer} METERS FROM XY')
-                base_img = BaseImage( # TODO Instantiate once/before the loop
-                        image_item=image, 
-                        band_list=self.available_bands, 
-                        bbox=bbox
-                    )
-            else: # TODO Add max buffer range
-                log.info(f'GETTING ENTIRE IMAGE INTERSECTING XY')
-                base_img = BaseImage(image_item=image, band_nums=self.available_bands) # TODO Convert to stateless class
-                
-            if annotate:
-                log.info('INCLUDING MAP ANNOTATIONS E.G. CAPTURE DATE, CLOUD COVER, ETC.')
-
-                if boundary:
-                    log.info('PLOTTING BOUNDARIES IN EXPORTS')
-                    
-                annt_img = AnnotatedImage(base_image=base_img)
-                out_file = annt_img.annotate(
-                    boundaries=PH_BDRYS, out_dir=PROCESSED_IMG_DIR, 
-                    lon=longitude, lat=latitude,
-                    plot_bdry=boundary,
-                    figsize=FIGSIZE, dpi=DPI,
-                    out_zip=f"{PROCESSED_IMG_DIR}/{start_time_readable}.zip"
-                )
+            log.info(f'GETTING ENTIRE IMAGE INTERSECTING XY')
+
+        if annotate:
+            log.info('INCLUDING MAP ANNOTATIONS E.G. CAPTURE DATE, CLOUD COVER, ETC.')
+            if boundary:
+                log.info('PLOTTING BOUNDARIES IN EXPORTS')
+        elif export_all:
+            log.info('GETTING ALL BANDS AND TRUE COLOR IMAGE')
+
+        mosaic_items = None
+        if MOSAIC and buffer > 0:
+            mosaic_items = get_mosaic_items(best_images, self.image_selection, longitude, latitude, buffer*1000)
+            for image_id, items in mosaic_items.items():
+                log.info(f'MOSAICKING {image_id} WITH {[item.id for item in items]}')
+
+        out_shape = self.get_read_shape() if buffer > 0 else None
+        if out_shape is not None:
+            log.info(f'READING AT {out_shape[1]}x{out_shape[0]} PIXELS FOR THE OUTPUT SIZE')
+
+        clip = partial(
+            clip_image, band_list=self.band_list, lon=longitude, lat=latitude, buffer=buffer,
+            mosaic_items=mosaic_items, out_shape=out_shape
+        )
+        annotate_kwargs = dict(lon=longitude, lat=latitude, plot_bdry=boundary, figsize=FIGSIZE, dpi=DPI, renderer=RENDERER)
+        archive = self.open_archive()
+        clip_seconds = []
+
+        # Windowed COG reads are I/O-bound so they always go to a thread pool. Rendering is CPU-bound
+        # and holds the GIL, so it either runs here in order or in a process pool.
+        # The archive is opened once for the whole job and entries are written in input order.
+        with ThreadPoolExecutor(max_workers=workers) as io_pool, archive or nullcontext():
+            def clipped_images():
+                for base_img, seconds in imap_ordered(io_pool, clip, best_images, prefetch=workers):
+                    clip_seconds.append(seconds)
+                    yield base_img
+
+            if RENDER_EXECUTOR == 'process' and workers > 1:
+                render_pool = ProcessPoolExecutor(max_workers=workers, mp_context=RENDER_CONTEXT)
+                render = partial(render_image, annotate=annotate, export_all=export_all, **annotate_kwargs)
+                rendered = imap_ordered(render_pool, render, clipped_images(), prefetch=workers)
             else:
-                if export_all:
-                    log.info('GETTING ALL BANDS AND TRUE COLOR IMAGE')
-                    out_file = base_img.export(export_rgb=True, out_dir=PROCESSED_IMG_DIR, to_zip=to_zip, runtime=start_time_readable)
-                else:
-                    out_file = base_img.export(out_dir=PROCESSED_IMG_DIR, to_zip=to_zip, runtime=start_time_readable)
-        end_time = time.time()
+                render_pool = None
+                export = partial(
+                    export_image, annotate=annotate, export_all=export_all, out_dir=self.out_dir, archive=archive, **annotate_kwargs
+                )
+                rendered = (timed(export, base_img) for base_img in clipped_images())
+
+            try:
+                for index, (result, render_seconds) in enumerate(rendered):
+                    if render_pool:
+                        out_files = write_entries(result, out_dir=self.out_dir, archive=archive)
+                    else:
+                        out_files = result
+                    out_file = out_files[-1]
+
+                    self._outputs_done(best_images[index].id, out_files, archive=archive)
+                    log.info(
+                        f'IMAGE {index + 1}/{len(best_images)} {best_images[index].id}: '
+                        f'CLIP {round(clip_seconds[index], 2)}s, RENDER {round(render_seconds, 2)}s'
+                    )
+            finally:
+                if render_pool:
+                    render_pool.shutdown()
 
-        log.info(f'OUT FILE: {out_file}')
-        log.info(f"FINISHED IN {round(end_time-start_time, 2)} SECONDS")
+        if WINDOW_CACHE is not None:
+            log.info(f'WINDOW CACHE: {WINDOW_CACHE.stats}')
 
-        return out_file
\ No newline at end of file
+        return self.finish_run(out_file)
\ No newline at end of file
@@ -0,0 +1,144 @@
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from pathlib import Path
+import dask
+import numpy as np
+import pandas as pd
+import rasterio
+import rioxarray as rxr
+import xarray as xr
+from eo.base_image import COG_ENV_OPTIONS
+from eo.constants import SCL_BAND, SCL_NODATA, SCL_CLOUD_CLASSES, COMPOSITE_METHODS
+from eo.image_utils import get_selection_table, group_by_period, get_item_bbox
+from eo.modes.basic import BasicMode, log, CONFIG
+
+COMPOSITE_CHUNK = CONFIG['composite']['chunk_size']
+
+
+def open_window(href, bbox, chunk) -> xr.DataArray:
+    """Lazily open the part of a COG within the bbox, each dask chunk is a separate windowed read"""
+    da = rxr.open_rasterio(href, chunks={'band': -1, 'y': chunk, 'x': chunk}, lock=False)
+    return da.rio.clip_box(*bbox.bounds)
+
+
+def enter_cog_env():
+    """Thread pool initializer for the dask reads. Outside the main thread GDAL config is per thread, so
+    each dask thread enters the COG settings itself instead of inheriting the task thread's."""
+    rasterio.Env(**COG_ENV_OPTIONS).__enter__()
+
+
+def build_composite(items, bbox, method='median', chunk=256) -> xr.DataArray:
+    """Per-pixel composite of the visual assets of items on the same grid, masking clouds with the SCL band.
+
+    `median` takes the median of the clear observations. `best` takes the pixel of the first item, in the
+    order given, that is clear there. Both fall back to the first item where no observation is clear.
+    Nothing is read until the result is computed, and then only one spatial chunk of every item at a time.
+    """
+    if method not in COMPOSITE_METHODS:
+        raise ValueError(f'Invalid composite method: {method}')
+
+    visuals, clear_masks = [], []
+    for item in items:
+        visual = open_window(item.assets['visual'].href, bbox, chunk)
+        scl = open_window(item.assets[SCL_BAND].href, bbox, chunk).isel(band=0, drop=True)
+        scl = scl.reindex_like(visual, method='nearest') # 20 m SCL onto the 10 m grid
+        clear = ~scl.isin(SCL_CLOUD_CLASSES) & (scl != SCL_NODATA) & (visual != 0).any('band')
+
+        visuals.append(visual)
+        clear_masks.append(clear)
+
+    if method == 'median':
+        stack = xr.concat(visuals, dim='time', join='override').chunk({'time': -1})
+        clear = xr.concat(clear_masks, dim='time', join='override').chunk({'time': -1})
+        composite = stack.astype(np.float32).where(clear).median('time', skipna=True)
+        composite = composite.fillna(visuals[0]).astype(np.uint8)
+    else:
+        # Fold from the last item to the first so the earliest clear item wins
+        composite = visuals[0]
+        for visual, clear in zip(reversed(visuals), reversed(clear_masks)):
+            composite = xr.where(clear, visual, composite)
+        composite = composite.transpose('band', 'y', 'x').astype(np.uint8)
+
+    return composite.rio.write_crs(visuals[0].rio.crs).rio.write_nodata(0)
+
+
+def write_composite(composite: xr.DataArray, out_file) -> str:
+    """Compute and write the composite one dask chunk at a time, so only a chunk of every item is in memory"""
+    composite.rio.to_raster(out_file, driver="GTiff", compress="deflate", tiled=True, lock=threading.Lock())
+    return out_file
+
+
+def get_period_label(dt: np.datetime64, frequency) -> str:
+    timestamp = pd.Timestamp(dt)
+    if frequency == 'monthly':
+        return timestamp.strftime('%Y-%m')
+    if frequency == 'quarterly':
+        return f'{timestamp.year}Q{timestamp.quarter}'
+    if frequency == 'yearly':
+        return str(timestamp.year)
+
+    return 'all'
+
+
+class CompositeMode(BasicMode):
+    """Cloud-free composite per month/quarter/year from every image in the period instead of the single best one"""
+    requires_buffer = True
+
+    def run(self):
+        self.start_run()
+
+        latitude = self.parameters.get('latitude')
+        longitude = self.parameters.get('longitude')
+        buffer = float(self.parameters.get('buffer'))
+        frequency = self.parameters.get('frequency')
+        method = self.parameters.get('composite')
+        workers = self.get_workers()
+
+        log.info(f'RUNNING IN COMPOSITE MODE: {method}')
+
+        items = list(self.image_selection)
+        table = get_selection_table(items)
+        if frequency:
+            groups = group_by_period(table, frequency)
+        else:
+            groups = [np.argsort(table['cloud_cover'], kind='stable')]
+
+        archive = self.open_archive()
+        self.progress.set_stage('processing', total=len(groups))
+
+        dask_pool = ThreadPoolExecutor(max_workers=workers, initializer=enter_cog_env)
+        with archive or nullcontext(), rasterio.Env(**COG_ENV_OPTIONS), dask_pool, \
+                dask.config.set(scheduler='threads', pool=dask_pool):
+            for group in groups:
+                # Only the least cloudy item's tile so all members share one grid
+                tile = table['mgrs_tile'][group[0]]
+                members = [items[i] for i in group if table['mgrs_tile'][i] == tile]
+                label = get_period_label(table['datetime'][group[0]], frequency)
+                bbox = get_item_bbox(members[0], longitude, latitude, buffer*1000)
+
+                period_start = time.time()
+                composite = build_composite(members, bbox, method=method, chunk=COMPOSITE_CHUNK)
+                filename = f'{label}_{tile}_{method}_composite.tif'
+
+                if archive is not None:
+                    # Through a hidden file on disk instead of a MemoryFile, evict_outputs() skips it.
+                    # Named uniquely since concurrent jobs on the same tile and period have the same filename.
+                    with tempfile.NamedTemporaryFile(dir=self.out_dir, prefix=f'.{filename}.', suffix='.part', delete=False) as part:
+                        part_file = Path(part.name)
+                    try:
+                        write_composite(composite, part_file)
+                        with open(part_file, 'rb') as f:
+                            out_file = self._write_output(filename, f, archive=archive)
+                    finally:
+                        part_file.unlink(missing_ok=True)
+                else:
+                    out_file = write_composite(composite, self.output_path(filename))
+
+                self._outputs_done(label, [out_file], archive=archive)
+
+                log.info(f'{label}: COMPOSITED {len(members)} IMAGES IN {round(time.time() - period_start, 2)}s')
+
+        return self.finish_run(out_file)
@@ -0,0 +1,88 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import partial
+import numpy as np
+from eo.image_utils import resolve_bands
+from eo.indices import get_index, to_reflectance, compute_index, encode_cog
+from eo.modes.basic import BasicMode, clip_image, log, CONFIG
+from eo.pool import imap_ordered
+
+INDEX_BATCH_SIZE = CONFIG['index']['batch_size']
+INDEX_MEMORY = CONFIG['index']['memory_mb'] * 1024 ** 2
+
+
+def get_batch_size(out_shape, n_bands, memory=INDEX_MEMORY, max_size=INDEX_BATCH_SIZE) -> int:
+    """Scenes per batch so the float32 band stacks and the index's intermediates fit in `memory` bytes"""
+    scene_bytes = out_shape[0] * out_shape[1] * np.dtype(np.float32).itemsize * (n_bands + 3)
+    return max(1, min(max_size, memory // scene_bytes))
+
+
+class IndexMode(BasicMode):
+    """Spectral index (e.g. NDVI) COGs of the selected images, computed over the time series in batches"""
+    requires_buffer = True
+
+    def __init__(self, parameters, progress=None, out_dir=None, items=None):
+        super().__init__(parameters, progress, out_dir, items)
+        self.index = get_index(self.parameters.get('index'))
+        self.band_list = resolve_bands(list(self.index.bands), self.item_assets)
+
+
+    def run(self):
+        self.start_run()
+
+        latitude = self.parameters.get('latitude')
+        longitude = self.parameters.get('longitude')
+        buffer = float(self.parameters.get('buffer'))
+        workers = self.get_workers()
+
+        log.info(f'COMPUTING {self.index.name.upper()} FROM BANDS: {self.band_list}')
+
+        best_images = self.select_images()
+
+        # Every band is read onto the grid of the finest one so the stacks line up across bands and scenes
+        resolution = min(self.item_assets[band]['gsd'] for band in self.band_list)
+        side = max(1, round(2 * buffer * 1000 / resolution))
+        out_shape = self.get_read_shape(annotate=False) or (side, side)
+        clip = partial(
+            clip_image, band_list=self.band_list, lon=longitude, lat=latitude, buffer=buffer, out_shape=out_shape
+        )
+        batch_size = get_batch_size(out_shape, len(self.band_list))
+        log.info(f'{batch_size} SCENES PER BATCH OF {out_shape[1]}x{out_shape[0]} PIXELS')
+        archive = self.open_archive()
+
+        with ThreadPoolExecutor(max_workers=workers) as io_pool, archive or nullcontext():
+            for start in range(0, len(best_images), batch_size):
+                batch_start = time.time()
+                batch = best_images[start:start + batch_size]
+
+                # One (time, y, x) reflectance stack per band filled as the scenes are read, only the
+                # grid of each clipped scene is kept, then a single vectorized index computation
+                band_stacks = [np.empty((len(batch), *out_shape), dtype=np.float32) for _ in self.band_list]
+                scenes = []
+                for position, (base_img, _) in enumerate(imap_ordered(io_pool, clip, batch, prefetch=workers)):
+                    bands = base_img.individual_bands_arr
+                    for stack, band in zip(band_stacks, self.band_list):
+                        stack[position] = to_reflectance(
+                            bands[band].values[0], base_img.image_item.properties, nodata=bands[band].attrs['nodata'] or 0
+                        )
+                    attrs = bands[self.band_list[0]].attrs
+                    scenes.append((base_img.image_item.id, attrs['transform'], attrs['crs']))
+                    del base_img, bands
+
+                index_stack = compute_index(self.index, band_stacks)
+                del band_stacks
+
+                for (image_id, transform, crs), values in zip(scenes, index_stack):
+                    filename = f'{image_id}_{self.index.name}.tif'
+
+                    with encode_cog(values, transform, crs) as memfile:
+                        out_file = self._write_output(filename, memfile, archive=archive)
+                    self._outputs_done(image_id, [out_file], archive=archive)
+
+                log.info(
+                    f'IMAGES {start + 1}-{start + len(batch)}/{len(best_images)}: '
+                    f'{self.index.name.upper()} IN {round(time.time() - batch_start, 2)}s'
+                )
+
+        return self.finish_run(out_file)
@@ -0,0 +1,179 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Dict, Iterator, List, Union
+import numpy as np
+import pandas as pd
+from shapely.geometry import box
+from eo.base_image import BaseImage
+from eo.constants import SCL_BAND, SCL_NODATA, SCL_CLOUD_CLASSES
+from eo.image_utils import resolve_bands, get_item_bbox
+from eo.indices import get_index, to_reflectance, compute_index
+from eo.modes.basic import BasicMode, log, CONFIG, BAND_WORKERS, WINDOW_CACHE
+from eo.pool import imap_ordered
+
+ZONAL_PERCENTILES = CONFIG['zonal']['percentiles']
+ZONAL_MASK_CLOUDS = CONFIG['zonal']['mask_clouds']
+ZONAL_CHUNK_PIXELS = CONFIG['zonal']['chunk_pixels']
+
+
+class WindowStats:
+    """Statistics of the finite index values of a window that is read in strips.
+
+    The count, mean, std, min and max are exact. The percentiles are exact if the window was read in
+    one strip, else they come from a histogram of `bins` bins over `value_range`, with values outside
+    it counted in the end bins.
+    """
+    def __init__(self, percentiles: List = ZONAL_PERCENTILES, bins: int = 2 ** 16, value_range: tuple = (-1, 1)):
+        self.percentiles = percentiles
+        self.value_range = value_range
+        self.edges = np.linspace(*value_range, bins + 1)
+        self.histogram = np.zeros(bins, dtype=np.int64)
+        self.count = 0
+        self.strips = 0
+        self.total = 0.0
+        self.total_squares = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self._values = None
+
+
+    def add(self, values: np.ndarray):
+        valid = values[np.isfinite(values)]
+        self.strips += 1
+        self._values = valid if self.strips == 1 else None # Only kept for exact percentiles of a single strip
+        if valid.size == 0:
+            return
+
+        self.count += valid.size
+        self.total += valid.sum(dtype=np.float64)
+        self.total_squares += np.square(valid, dtype=np.float64).sum()
+        self.min = min(self.min, float(valid.min()))
+        self.max = max(self.max, float(valid.max()))
+        self.histogram += np.histogram(np.clip(valid, *self.value_range), bins=self.edges)[0]
+
+
+    def _percentile(self, percentile) -> float:
+        cumulative = np.cumsum(self.histogram)
+        rank = percentile / 100 * (self.count - 1)
+        bin_index = min(int(np.searchsorted(cumulative, rank, side='right')), len(self.histogram) - 1)
+        center = (self.edges[bin_index] + self.edges[bin_index + 1]) / 2
+
+        return float(np.clip(center, self.min, self.max))
+
+
+    def result(self) -> Dict:
+        stats = {'valid_pixels': int(self.count)}
+
+        if self.count == 0:
+            return {**stats, 'mean': None, 'std': None, 'min': None, 'max': None, **{f'p{p}': None for p in self.percentiles}}
+
+        mean = self.total / self.count
+        stats.update({
+            'mean': float(mean),
+            'std': float(np.sqrt(max(self.total_squares / self.count - mean ** 2, 0))),
+            'min': self.min,
+            'max': self.max,
+        })
+        if self._values is not None:
+            values = np.percentile(self._values, self.percentiles)
+        else:
+            values = [self._percentile(percentile) for percentile in self.percentiles]
+        for percentile, value in zip(self.percentiles, values):
+            stats[f'p{percentile}'] = float(value)
+
+        return stats
+
+
+def get_strips(bbox, resolution: float, max_pixels: int) -> Iterator[tuple]:
+    """Split a bbox into strips of whole rows at `resolution`, at most `max_pixels` each. Yields (strip bbox, (rows, columns))."""
+    minx, miny, maxx, maxy = bbox.bounds
+    width = max(1, round((maxx - minx) / resolution))
+    height = max(1, round((maxy - miny) / resolution))
+    rows = max(1, max_pixels // width)
+
+    for top in range(0, height, rows):
+        n_rows = min(rows, height - top)
+        yield box(minx, maxy - (top + n_rows) * resolution, maxx, maxy - top * resolution), (n_rows, width)
+
+
+class ZonalStatsMode(BasicMode):
+    """Per-date statistics of a spectral index and cloud cover over the AOI, without writing any rasters.
+
+    Windows are read at the native resolution of the index bands, in strips of at most `zonal.chunk_pixels`
+    pixels that go through the reducer as soon as they are read, so only each image's row is kept.
+    """
+    requires_buffer = True
+
+    def __init__(self, parameters, progress=None, out_dir=None, items=None):
+        super().__init__(parameters, progress, out_dir, items)
+        self.index = get_index(self.parameters.get('index') or 'ndvi')
+        self.index_bands = resolve_bands(list(self.index.bands), self.item_assets)
+        self.band_list = [*self.index_bands, SCL_BAND]
+
+
+    def run(self, output_format='json') -> Union[List[Dict], str]:
+        self.start_run()
+
+        latitude = self.parameters.get('latitude')
+        longitude = self.parameters.get('longitude')
+        buffer = float(self.parameters.get('buffer'))
+        workers = self.get_workers()
+
+        log.info(f'ZONAL STATISTICS OF {self.index.name.upper()} FROM BANDS: {self.band_list}')
+
+        best_images = self.select_images()
+
+        resolution = min(self.item_assets[band]['gsd'] for band in self.index_bands)
+        reduce = partial(self.reduce_image, lon=longitude, lat=latitude, buffer=buffer, resolution=resolution)
+        rows = []
+
+        with ThreadPoolExecutor(max_workers=workers) as io_pool:
+            for row, seconds in imap_ordered(io_pool, reduce, best_images, prefetch=workers):
+                rows.append(row)
+                self.progress.image_done(row['id'])
+                log.info(f"{row['id']}: READ AND REDUCED IN {round(seconds, 2)}s")
+
+        if output_format == 'parquet':
+            out_file = self.output_path(f'{self.run_name}_{self.index.name}.parquet')
+            pd.DataFrame(rows).to_parquet(out_file, index=False)
+            return self.finish_run(out_file)
+
+        self.finish_run()
+        return rows
+
+
+    def reduce_image(self, image, lon, lat, buffer, resolution) -> Dict:
+        """Row of statistics of one image, read strip by strip at `resolution`"""
+        properties = image.properties
+        stats = WindowStats()
+        scl_valid, scl_cloud = 0, 0
+
+        for strip, out_shape in get_strips(get_item_bbox(image, lon, lat, buffer*1000), resolution, ZONAL_CHUNK_PIXELS):
+            base_img = BaseImage(
+                image_item=image, band_list=self.band_list, bbox=strip,
+                band_workers=BAND_WORKERS, window_cache=WINDOW_CACHE, out_shape=out_shape
+            )
+            bands = base_img.individual_bands_arr
+            scl = bands[SCL_BAND].values[0]
+
+            values = compute_index(self.index, [
+                to_reflectance(bands[band].values[0], properties, nodata=bands[band].attrs['nodata'] or 0)
+                for band in self.index_bands
+            ])
+            if ZONAL_MASK_CLOUDS:
+                values[np.isin(scl, SCL_CLOUD_CLASSES) | (scl == SCL_NODATA)] = np.nan
+
+            stats.add(values)
+            valid = scl != SCL_NODATA
+            scl_valid += int(valid.sum())
+            scl_cloud += int(np.isin(scl[valid], SCL_CLOUD_CLASSES).sum())
+
+        return {
+            'id': image.id,
+            'datetime': properties['datetime'],
+            'mgrs_tile': properties.get('s2:mgrs_tile'),
+            'scene_cloud_cover': properties.get('eo:cloud_cover'),
+            'aoi_cloud_fraction': scl_cloud / scl_valid if scl_valid else 1.0, # Same as get_cloud_fraction()
+            'resolution_m': resolution,
+            **{f'{self.index.name}_{name}': value for name, value in stats.result().items()}
+        }
@@ -0,0 +1,34 @@
+import sys
+import time
+from collections import deque
+from concurrent.futures import Executor
+from typing import Callable, Iterable, Iterator
+
+
+def native_threads() -> bool:
+    """False under gevent's monkey-patching, where threads are greenlets on one OS thread and blocking GDAL reads do not overlap"""
+    gevent_monkey = sys.modules.get('gevent.monkey')
+    return gevent_monkey is None or not gevent_monkey.is_module_patched('threading')
+
+
+def timed(func: Callable, *args, **kwargs) -> tuple:
+    """Call a function and return its result with the elapsed seconds. Module-level so process pools can pickle it."""
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def imap_ordered(executor: Executor, func: Callable, items: Iterable, prefetch: int) -> Iterator[tuple]:
+    """Like :meth:`Executor.map` but yields (result, seconds) and keeps at most `prefetch` tasks in flight.
+
+    Results come back in input order so outputs are deterministic, and bounding the in-flight
+    tasks keeps the clipped arrays of a long time series from piling up in memory.
+    """
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(timed, func, item))
+        if len(pending) >= max(1, prefetch):
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
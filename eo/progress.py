@@ -0,0 +1,116 @@
+import json
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, Iterator, Union
+
+
+class JobProgress:
+    """Stage, images done out of the total and outputs written so far of a running job.
+
+    Every change is passed to `callback` as a dict, e.g. :meth:`ProgressStore.publish`.
+    Without a callback it only keeps the state, e.g. in the CLI.
+    """
+    def __init__(self, callback:Union[Callable, None] = None):
+        self.callback = callback
+        self.stage = 'queued'
+        self.done = 0
+        self.total = None
+        self.image_id = None
+        self.outputs = []
+        self.error = None
+        self._lock = threading.Lock()
+
+
+    def state(self) -> Dict:
+        return {
+            'stage': self.stage,
+            'done': self.done,
+            'total': self.total,
+            'image_id': self.image_id,
+            'bytes_written': sum(output['bytes'] for output in self.outputs),
+            'outputs': list(self.outputs),
+            'error': self.error,
+            'updated': time.time(),
+        }
+
+
+    def _report(self):
+        if self.callback is not None:
+            self.callback(self.state())
+
+
+    def set_stage(self, stage, total=None):
+        with self._lock:
+            self.stage = stage
+            if total is not None:
+                self.total = total
+            self._report()
+
+
+    def image_done(self, image_id, outputs=(), archive=None):
+        """Count an image (or period) as done with the files it wrote, or the entries it added to `archive`"""
+        with self._lock:
+            for output in outputs:
+                if archive is not None:
+                    record = {'name': output, **archive.locate(output)}
+                else:
+                    path = Path(output).resolve()
+                    record = {'name': path.name, 'path': str(path), 'bytes': path.stat().st_size}
+                self.outputs.append({**record, 'image_id': image_id})
+
+            self.done += 1
+            self.image_id = image_id
+            self._report()
+
+
+    def fail(self, error):
+        with self._lock:
+            self.stage = 'failed'
+            self.error = str(error)
+            self._report()
+
+
+class ProgressStore:
+    """Latest progress of each job in Redis, also published on a channel per job so watchers
+    get the changes without polling"""
+    def __init__(self, client, ttl:float = 86400, prefix:str = 'eo:progress'):
+        self.client = client
+        self.ttl = int(ttl)
+        self.prefix = prefix
+
+
+    def _key(self, task_id) -> str:
+        return f'{self.prefix}:{task_id}'
+
+
+    def publish(self, task_id, state:Dict):
+        message = json.dumps(state, default=str)
+        pipeline = self.client.pipeline()
+        pipeline.set(self._key(task_id), message, ex=self.ttl)
+        pipeline.publish(self._key(task_id), message)
+        pipeline.execute()
+
+
+    def get(self, task_id) -> Union[Dict, None]:
+        state = self.client.get(self._key(task_id))
+        return json.loads(state) if state is not None else None
+
+
+    def subscribe(self, task_id, timeout:float = 300, heartbeat:float = 2) -> Iterator[Union[Dict, None]]:
+        """Yield the latest progress, then every change for up to `timeout` seconds.
+        Yields None every `heartbeat` seconds without a change."""
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self._key(task_id))
+        try:
+            # Read after subscribing so no change is missed in between
+            latest = self.get(task_id)
+            if latest is not None:
+                yield latest
+
+            deadline = time.monotonic() + timeout
+            while time.monotonic() < deadline:
+                message = pubsub.get_message(timeout=heartbeat)
+                yield json.loads(message['data']) if message is not None else None
+        finally:
+            pubsub.close()
@@ -0,0 +1,79 @@
+import numpy as np
+from typing import List, Sequence, Tuple
+
+# NOTE The Sentinel-2 bands are uint16 (max 65535) and the visual asset is uint8, so a band's
+#  histogram is a single bincount and its percentiles come from the cumulative counts, no sorting.
+#  Stretching is then a lookup table over every possible value, applied with one np.take.
+INTEGER_DTYPES = (np.uint8, np.uint16)
+
+
+def band_histogram(band: np.ndarray, nodata=0) -> np.ndarray:
+    """Counts of every integer value in the band, the nodata value not counted"""
+    if band.dtype not in INTEGER_DTYPES:
+        raise ValueError(f'Histogram stretch needs uint8/uint16 bands, got {band.dtype}')
+
+    counts = np.bincount(band.ravel(), minlength=np.iinfo(band.dtype).max + 1)
+    if nodata is not None and 0 <= nodata < counts.size:
+        counts[int(nodata)] = 0
+
+    return counts
+
+
+def histogram_percentiles(counts: np.ndarray, lower: float, upper: float) -> Tuple[int, int]:
+    """Values at the `lower` and `upper` percentiles of a histogram"""
+    cumulative = np.cumsum(counts)
+    total = cumulative[-1]
+    if total == 0:
+        return 0, 0
+
+    low, high = np.searchsorted(cumulative, [total * lower / 100.0, total * upper / 100.0])
+    return int(low), int(high)
+
+
+def shared_percentiles(band_stacks: Sequence[Sequence[np.ndarray]], lower, upper, nodata=0) -> List[Tuple[int, int]]:
+    """Per band percentiles over a whole time series, e.g. `[[red_1, red_2, ...], [green_1, ...], ...]`,
+    so every frame is stretched the same way"""
+    percentiles = []
+    for frames in band_stacks:
+        counts = sum(band_histogram(frame, nodata) for frame in frames)
+        percentiles.append(histogram_percentiles(counts, lower, upper))
+
+    return percentiles
+
+
+def stretch_lut(low: int, high: int, size: int, gamma=1.0, max_val=255, nodata=0) -> np.ndarray:
+    """uint8 lookup table of every integer value: clip to [low, high], scale to [0, 1], gamma, then `max_val`"""
+    values = np.arange(size, dtype=np.float32)
+    values -= low
+    values /= max(high - low, 1)
+    np.clip(values, 0, 1, out=values)
+    if gamma != 1:
+        np.power(values, 1 / gamma, out=values)
+    values *= max_val
+
+    lut = values.astype(np.uint8)
+    if nodata is not None and 0 <= nodata < size:
+        lut[int(nodata)] = 0
+
+    return lut
+
+
+def stretch_bands(
+        bands: Sequence[np.ndarray], lower=2, upper=98, gamma=1.0, max_val=255, nodata=0,
+        percentiles: Sequence[Tuple[int, int]] = None, out: np.ndarray = None
+    ) -> np.ndarray:
+    """Stretch each 2D band with its histogram percentiles (or the given `percentiles`) into a
+    (band, y, x) uint8 buffer, allocated once unless `out` is given"""
+    if out is None:
+        out = np.empty((len(bands), *bands[0].shape), dtype=np.uint8)
+
+    for i, band in enumerate(bands):
+        if percentiles is None:
+            low, high = histogram_percentiles(band_histogram(band, nodata), lower, upper)
+        else:
+            low, high = percentiles[i]
+
+        lut = stretch_lut(low, high, np.iinfo(band.dtype).max + 1, gamma=gamma, max_val=max_val, nodata=nodata)
+        np.take(lut, band, out=out[i])
+
+    return out
@@ -0,0 +1,137 @@
+import ctypes
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from prometheus_client import Counter, Gauge, Histogram, REGISTRY
+from prometheus_client.core import CounterMetricFamily
+from . import PROJECT_DIR
+
+# Read by GDAL when vsicurl first checks it, so it has to be set before any remote read
+os.environ.setdefault('CPL_VSIL_NETWORK_STATS_ENABLED', 'YES')
+
+SPAN_LOG = PROJECT_DIR / 'logs/spans.jsonl'
+
+STAGE_SECONDS = Histogram(
+    'eo_stage_seconds', 'Wall time per stage', ['stage'],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+)
+STAGE_ERRORS = Counter('eo_stage_errors', 'Stages that raised', ['stage'])
+PEAK_RSS = Gauge('eo_peak_rss_bytes', 'Peak resident memory of the process')
+
+
+class _VSIStats:
+    """GDAL's network statistics (CPL_VSIL_NETWORK_STATS_ENABLED) read through the C API.
+
+    rasterio wheels bundle their own libgdal, separate from the one the osgeo bindings link,
+    so the stats are read from the copy that rasterio loaded into this process.
+    """
+    def __init__(self):
+        self._lib = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+
+    def _load(self):
+        import rasterio._base # Loads libgdal
+
+        try:
+            with open('/proc/self/maps') as f:
+                paths = sorted({line.split()[-1] for line in f if 'libgdal' in line})
+            lib = ctypes.CDLL(paths[0])
+            lib.VSINetworkStatsGetAsSerializedJSON.restype = ctypes.c_void_p
+            lib.VSINetworkStatsGetAsSerializedJSON.argtypes = [ctypes.c_void_p]
+            lib.VSIFree.argtypes = [ctypes.c_void_p]
+            return lib
+        except (OSError, IndexError, AttributeError):
+            return None
+
+
+    def get(self) -> tuple:
+        """Total (requests, bytes) fetched by the process so far, (0, 0) if the stats are unavailable"""
+        with self._lock:
+            if not self._loaded:
+                self._lib = self._load()
+                self._loaded = True
+
+        if self._lib is None:
+            return 0, 0
+
+        pointer = self._lib.VSINetworkStatsGetAsSerializedJSON(None)
+        if not pointer:
+            return 0, 0
+        try:
+            methods = json.loads(ctypes.string_at(pointer).decode()).get('methods', {})
+        finally:
+            self._lib.VSIFree(pointer)
+
+        return (
+            sum(method.get('count', 0) for method in methods.values()),
+            sum(method.get('downloaded_bytes', 0) for method in methods.values())
+        )
+
+
+VSI_STATS = _VSIStats()
+
+
+class _HTTPTotals:
+    """GDAL's HTTP requests and bytes of the whole process, read when metrics are scraped.
+
+    GDAL only counts per process, and images and tasks run concurrently, so the traffic cannot be
+    split by stage. It is only read once rasterio is loaded, so the web app never imports it for /metrics.
+    """
+    def collect(self):
+        requests, fetched = VSI_STATS.get() if 'rasterio' in sys.modules else (0, 0)
+        yield CounterMetricFamily('eo_http_requests', 'HTTP requests made by GDAL in this process', value=requests)
+        yield CounterMetricFamily('eo_http_bytes', 'Bytes fetched by GDAL in this process', value=fetched)
+
+
+REGISTRY.register(_HTTPTotals())
+
+
+def span_logger(log_file=SPAN_LOG) -> logging.Logger:
+    """One JSON object per line, appended since the app and the workers share the file"""
+    Path(log_file).parent.mkdir(parents=True, exist_ok=True)
+    logger = logging.getLogger('eo_spans')
+    if not logger.handlers:
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        handler = logging.FileHandler(log_file, mode='a')
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+
+    return logger
+
+
+@contextmanager
+def span(stage, **attrs):
+    """Time a stage and record the process' peak memory and any `attrs` e.g. image_id.
+    The yielded dict can take more attributes.
+    """
+    record = {'stage': stage, **attrs}
+    start = time.perf_counter()
+    try:
+        yield record
+        record['status'] = 'ok'
+    except Exception:
+        record['status'] = 'error'
+        STAGE_ERRORS.labels(stage).inc()
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # KB on Linux
+
+        record.update({
+            'seconds': round(seconds, 4),
+            'peak_rss_mb': round(peak_rss / 1024 ** 2, 1),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        })
+        STAGE_SECONDS.labels(stage).observe(seconds)
+        PEAK_RSS.set(peak_rss)
+        span_logger().info(json.dumps(record, default=str))
+
@@ -14,7 +14,7 @@ def simplify_datetime(date, compact=False):
 
 def list_intersecting_municipalities(municipalities: gpd.GeoDataFrame):
     """Return the province with the highest total area of intersection and its top 3 municipalities."""
-    municipalities["area"] = municipalities.geometry.area 
+    municipalities = municipalities.assign(area=municipalities.geometry.area) # Don't mutate the caller's frame
 
     # Sum total area per province
     province_area = (
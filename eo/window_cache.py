@@ -0,0 +1,108 @@
+import hashlib
+import json
+import os
+import threading
+import numpy as np
+from pathlib import Path
+from typing import Dict, List, Union
+from urllib.parse import urlsplit, urlunsplit
+
+
+def strip_signature(href:str) -> str:
+    """Drop the query string, e.g. the Planetary Computer SAS token, so the key survives re-signing"""
+    parts = urlsplit(href)
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, '', ''))
+
+
+class WindowCache:
+    """Content-addressed cache of windowed COG reads on local disk.
+
+    Entries are keyed on the unsigned asset href, the bounds of the window in the asset's CRS
+    and the output shape (i.e. the overview level read). Files are evicted least recently used
+    first once the directory grows past `max_bytes`, and live on disk so they survive restarts.
+    """
+    def __init__(self, cache_dir:Union[str, Path], max_bytes:int):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._size = sum(stat.st_size for _, stat in self._files())
+
+
+    def _files(self) -> List[tuple]:
+        """(path, stat) of the cached files, skipping those another worker evicted in the meantime"""
+        files = []
+        for path in self.cache_dir.glob('*.npz'):
+            try:
+                files.append((path, path.stat()))
+            except FileNotFoundError:
+                continue
+
+        return files
+
+
+    @staticmethod
+    def key(href:Union[str, List[str]], bounds:tuple, out_shape:Union[tuple, None] = None, crs = None) -> str:
+        """A list of hrefs keys a mosaic of those assets. `crs` is that of the bounds if they are not in the assets' own."""
+        hrefs = [href] if isinstance(href, str) else href
+        parts = [[strip_signature(h) for h in hrefs], [round(float(b), 6) for b in bounds], list(out_shape) if out_shape else None]
+        if crs is not None:
+            parts.append(str(crs))
+        return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+
+    def get(self, key:str) -> Union[tuple, None]:
+        """Returns the cached array and its attributes or None"""
+        path = self.cache_dir / f'{key}.npz'
+        try:
+            with np.load(path) as npz:
+                data = npz['data']
+                attrs = json.loads(str(npz['attrs']))
+            os.utime(path) # Bump the mtime that the LRU eviction sorts on
+        except (FileNotFoundError, ValueError, OSError):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return data, attrs
+
+
+    def put(self, key:str, data:np.ndarray, attrs:Dict):
+        path = self.cache_dir / f'{key}.npz'
+        tmp_path = self.cache_dir / f'{key}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, data=data, attrs=json.dumps(attrs))
+            size = f.tell()
+        tmp_path.replace(path) # Atomic so readers in other workers never see a partial file
+
+        with self._lock:
+            self._size += size
+            if self._size > self.max_bytes:
+                self._evict()
+
+
+    def _evict(self):
+        """Delete the least recently used files until the cache is at 90% of its cap"""
+        files = sorted(self._files(), key=lambda file: file[1].st_mtime)
+        self._size = sum(stat.st_size for _, stat in files)
+
+        for path, stat in files:
+            if self._size <= self.max_bytes * 0.9:
+                break
+            path.unlink(missing_ok=True) # Another worker may have evicted it first
+            self._size -= stat.st_size
+
+
+    @property
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else None,
+            "size_mb": round(self._size / 1024 ** 2, 1),
+        }
@@ -0,0 +1,67 @@
+import io
+from datetime import datetime
+
+import numpy as np
+import pytest
+from PIL import Image, ImageSequence
+
+from eo.gif import GifWriter
+from eo.image_utils import get_best_images
+from tests.test_image_utils import make_item
+
+
+def make_frame(seed, size=(40, 30)):
+    rgb = np.random.default_rng(seed).integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)
+    return Image.fromarray(rgb)
+
+
+def write_gif(frames, **kwargs) -> bytes:
+    buffer = io.BytesIO()
+    with GifWriter(buffer, **kwargs) as gif:
+        for frame in frames:
+            gif.append(frame)
+
+    return buffer.getvalue()
+
+
+def read_frames(data: bytes) -> list:
+    with Image.open(io.BytesIO(data)) as gif:
+        return [(np.asarray(frame.convert('RGB')), frame.info.get('duration')) for frame in ImageSequence.Iterator(gif)]
+
+
+def test_frames_keep_their_own_palettes():
+    # Noise, a single colour and a quantized frame, so the local color tables have very different sizes
+    frames = [make_frame(0), Image.new('RGB', (40, 30), (200, 30, 90)), make_frame(1).quantize(colors=4)]
+
+    written = read_frames(write_gif(frames, duration_ms=250))
+
+    assert len(written) == 3
+    for frame, (pixels, duration) in zip(frames, written):
+        expected = frame if frame.mode == 'P' else frame.quantize(colors=256, method=Image.Quantize.MEDIANCUT)
+        assert (pixels == np.asarray(expected.convert('RGB'))).all()
+        assert duration == 250
+
+
+def test_frames_of_periods_without_a_scene_are_skipped():
+    # February has no scene, so the GIF goes straight from January to March
+    items = [
+        make_item('jan', datetime(2024, 1, 10), 20.0),
+        make_item('mar-cloudy', datetime(2024, 3, 3), 70.0),
+        make_item('mar', datetime(2024, 3, 20), 10.0),
+    ]
+    best_images = list(get_best_images(items, 'monthly'))
+    frames = {'jan': make_frame(2), 'mar': make_frame(3)}
+
+    written = read_frames(write_gif([frames[item.id] for item in best_images]))
+
+    assert [item.id for item in best_images] == ['jan', 'mar']
+    assert len(written) == 2
+    assert not (written[0][0] == written[1][0]).all()
+
+
+def test_frame_size_must_match():
+    buffer = io.BytesIO()
+    with GifWriter(buffer) as gif:
+        gif.append(make_frame(0))
+        with pytest.raises(ValueError):
+            gif.append(make_frame(1, size=(41, 30)))
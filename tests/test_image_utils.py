@@ -0,0 +1,45 @@
+from datetime import datetime
+
+import pystac
+
+from eo.image_utils import get_best_images
+
+
+def make_item(item_id, capture_date, cloud_cover, x=121.0, y=14.0):
+    return pystac.Item(
+        item_id, {'type': 'Point', 'coordinates': [x, y]}, [x, y, x, y], capture_date,
+        {'datetime': capture_date.isoformat() + 'Z', 'eo:cloud_cover': cloud_cover}
+    )
+
+
+def test_best_images_least_cloudy_per_period():
+    items = [
+        make_item('jan-cloudy', datetime(2024, 1, 5), 40.0),
+        make_item('jan-clear', datetime(2024, 1, 20), 5.0),
+        make_item('feb-only', datetime(2024, 2, 10), 90.0),
+    ]
+
+    assert [item.id for item in get_best_images(items, 'monthly')] == ['jan-clear', 'feb-only']
+
+
+def test_best_images_ties_go_to_earliest():
+    # Newest first like the catalog returns them, as pd.Grouper/idxmin did the earliest wins
+    items = [
+        make_item('late', datetime(2024, 3, 25), 10.0),
+        make_item('mid', datetime(2024, 3, 12), 10.0),
+        make_item('early', datetime(2024, 3, 2), 10.0),
+        make_item('cloudy', datetime(2024, 3, 1), 60.0),
+    ]
+
+    assert [item.id for item in get_best_images(items, 'monthly')] == ['early']
+    assert [item.id for item in get_best_images(items, 'yearly')] == ['early']
+
+
+def test_best_images_same_datetime_keeps_catalog_order():
+    # Neighbouring MGRS tiles of one pass share the datetime
+    items = [
+        make_item('tile-b', datetime(2024, 3, 2), 10.0),
+        make_item('tile-a', datetime(2024, 3, 2), 10.0),
+    ]
+
+    assert [item.id for item in get_best_images(items, 'monthly')] == ['tile-b']
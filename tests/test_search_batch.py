@@ -0,0 +1,120 @@
+from datetime import datetime
+
+import pystac
+import pytest
+
+import eo.image_utils as image_utils
+from eo.dataclasses.base_image_collection import BaseImageCollection
+from eo.image_utils import group_date_ranges, search_catalog_batch
+
+COLLECTION = 'sentinel-2-l2a'
+
+
+def make_scene(item_id, capture_date, coordinates):
+    xs, ys = zip(*coordinates)
+    return pystac.Item(
+        item_id, {'type': 'Polygon', 'coordinates': [coordinates]}, [min(xs), min(ys), max(xs), max(ys)],
+        capture_date, {'datetime': capture_date.isoformat() + 'Z', 'eo:cloud_cover': 10.0}
+    )
+
+
+def square(x, y, size=1.0):
+    return [[x, y], [x + size, y], [x + size, y + size], [x, y + size], [x, y]]
+
+
+def make_imgcol(lon, lat, start_date='2024-01-01', end_date='2024-01-31'):
+    return BaseImageCollection(start_date=start_date, end_date=end_date, lat=lat, lon=lon, collection=COLLECTION)
+
+
+@pytest.fixture
+def catalog(monkeypatch):
+    """Scenes returned by every search and the (geometry, date range) of each request"""
+    scenes, requests = [], []
+
+    def fake_search(collection, geometry, date_range):
+        requests.append((geometry, date_range))
+        return pystac.ItemCollection(scenes)
+
+    monkeypatch.setattr(image_utils, '_search', fake_search)
+    return scenes, requests
+
+
+def ids(items):
+    return sorted(item.id for item in items)
+
+
+def test_items_split_by_footprint(catalog):
+    scenes, requests = catalog
+    scenes += [
+        make_scene('west', datetime(2024, 1, 5), square(120, 14)),
+        make_scene('east', datetime(2024, 1, 5), square(122, 14)),
+        make_scene('both', datetime(2024, 1, 9), square(120, 14, size=3)),
+    ]
+
+    results = search_catalog_batch([make_imgcol(120.5, 14.5), make_imgcol(122.5, 14.5), make_imgcol(125.5, 14.5)])
+
+    assert len(requests) == 1
+    assert requests[0][0]['type'] == 'MultiPoint'
+    assert [ids(items) for items in results] == [['both', 'west'], ['both', 'east'], []]
+
+
+def test_footprint_not_bbox(catalog):
+    # A swath edge: the AOI is inside the scene's bbox but not its footprint
+    scenes, _ = catalog
+    scenes.append(make_scene('triangle', datetime(2024, 1, 5), [[120, 14], [121, 14], [120, 15], [120, 14]]))
+
+    results = search_catalog_batch([make_imgcol(120.2, 14.2), make_imgcol(120.8, 14.8)])
+
+    assert [ids(items) for items in results] == [['triangle'], []]
+
+
+def test_items_split_by_date(catalog):
+    scenes, requests = catalog
+    scenes += [
+        make_scene('jan-31', datetime(2024, 1, 31, 2, 30), square(120, 14)),
+        make_scene('feb', datetime(2024, 2, 14), square(120, 14)),
+    ]
+
+    results = search_catalog_batch([
+        make_imgcol(120.5, 14.5, '2024-01-01', '2024-01-31'), # Date-only end dates cover the whole day
+        make_imgcol(120.5, 14.5, '2024-01-15', '2024-02-29'),
+    ])
+
+    assert len(requests) == 1
+    assert requests[0][1] == '2024-01-01/2024-02-29'
+    assert [ids(items) for items in results] == [['jan-31'], ['feb', 'jan-31']]
+
+
+def test_disjoint_dates_searched_apart(catalog):
+    scenes, requests = catalog
+    scenes.append(make_scene('2022', datetime(2022, 6, 1), square(120, 14)))
+
+    results = search_catalog_batch([
+        make_imgcol(120.5, 14.5, '2022-01-01', '2022-12-31'),
+        make_imgcol(120.5, 14.5, '2024-01-01', '2024-12-31'),
+    ])
+
+    assert sorted(date_range for _, date_range in requests) == ['2022-01-01/2022-12-31', '2024-01-01/2024-12-31']
+    assert [ids(items) for items in results] == [['2022'], []]
+
+
+def test_consecutive_dates_searched_together(catalog):
+    # Nothing in between to pull in
+    _, requests = catalog
+
+    search_catalog_batch([
+        make_imgcol(120.5, 14.5, '2023-01-01', '2023-12-31'),
+        make_imgcol(121.5, 14.5, '2024-01-01', '2024-12-31'),
+    ])
+
+    assert [date_range for _, date_range in requests] == ['2023-01-01/2024-12-31']
+
+
+def test_no_items(catalog):
+    assert [len(items) for items in search_catalog_batch([make_imgcol(120.5, 14.5), make_imgcol(121.5, 14.5)])] == [0, 0]
+
+
+def test_group_date_ranges():
+    starts, ends = [5, 0, 20, 8], [10, 6, 30, 12]
+
+    assert group_date_ranges(starts, ends) == [[1, 0, 3], [2]]
@@ -0,0 +1,120 @@
+import json
+import os
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+import planetary_computer
+import pystac
+import pytest
+
+import eo.image_utils as image_utils
+from eo.dataclasses.base_image_collection import BaseImageCollection
+from eo.image_utils import SearchCache, sign_items, unsign_items
+
+HREF = 'https://sentinel2l2a01.blob.core.windows.net/sentinel2-l2/51/P/TS/B04.tif'
+
+
+def make_imgcol(lon=121.0, lat=14.6):
+    return BaseImageCollection(start_date='2024-01-01', end_date='2024-12-31', lat=lat, lon=lon, collection='sentinel-2-l2a')
+
+
+def make_items(item_id='S2A_51PTS', token='sv=2021&sig=old'):
+    item = pystac.Item(
+        item_id, {'type': 'Point', 'coordinates': [121.0, 14.6]}, [121.0, 14.6, 121.0, 14.6], datetime(2024, 3, 2),
+        {'datetime': '2024-03-02T02:30:00Z', 'eo:cloud_cover': 10.0},
+        assets={'B04': pystac.Asset(f'{HREF}?{token}')}
+    )
+    return pystac.ItemCollection([item])
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Time seen by the cache, moved forward by hand"""
+    clock = SimpleNamespace(now=time.time())
+    monkeypatch.setattr(image_utils, 'time', SimpleNamespace(time=lambda: clock.now))
+    return clock
+
+
+@pytest.fixture(autouse=True)
+def signer(monkeypatch):
+    """Sign with a new token and count the signings instead of asking the Planetary Computer"""
+    signed = []
+
+    def sign(collection):
+        for item in collection:
+            for asset in item.assets.values():
+                asset.href = f'{asset.href}?sv=2021&sig=new'
+        signed.append(collection)
+        return collection
+
+    monkeypatch.setattr(planetary_computer, 'sign', sign)
+    return signed
+
+
+def test_hit_until_ttl(clock):
+    cache = SearchCache(ttl=60)
+    imgcol, items = make_imgcol(), make_items()
+    cache.put(imgcol, items)
+
+    clock.now += 59
+    assert cache.get(imgcol) is items
+    clock.now += 1
+    assert cache.get(imgcol) is None
+    assert cache.stats == {'hits': 1, 'misses': 1, 'entries': 0}
+
+
+def test_oldest_evicted_past_max_entries(clock, tmp_path):
+    cache = SearchCache(ttl=60, cache_dir=tmp_path, max_entries=2)
+    imgcols = [make_imgcol(lon=121.0 + i) for i in range(3)]
+    for i, imgcol in enumerate(imgcols):
+        cache.put(imgcol, make_items(f'S2A_{i}'))
+        os.utime(cache._disk_path(imgcol), (clock.now, clock.now))
+        clock.now += 1
+
+    assert cache.stats['entries'] == 2
+    assert not cache._disk_path(imgcols[0]).exists()
+    assert cache.get(imgcols[0]) is None
+    assert [item.id for item in cache.get(imgcols[2])] == ['S2A_2']
+
+
+def test_expired_files_evicted(clock, tmp_path):
+    cache = SearchCache(ttl=60, cache_dir=tmp_path)
+    old, new = make_imgcol(lon=121.0), make_imgcol(lon=122.0)
+    cache.put(old, make_items())
+    os.utime(cache._disk_path(old), (clock.now - 61, clock.now - 61)) # e.g. written by another worker
+
+    cache.put(new, make_items())
+
+    assert not cache._disk_path(old).exists()
+    assert cache._disk_path(new).exists()
+
+
+def test_disk_entries_without_sas_tokens(clock, tmp_path, signer):
+    imgcol = make_imgcol()
+    SearchCache(ttl=60, cache_dir=tmp_path).put(imgcol, make_items())
+
+    [path] = tmp_path.glob('*.json')
+    assert 'sig=' not in path.read_text()
+    assert json.loads(path.read_text())['features'][0]['assets']['B04']['href'] == HREF
+
+    # A new worker reads the entry from disk and signs it again
+    items = SearchCache(ttl=60, cache_dir=tmp_path).get(imgcol)
+    assert items[0].assets['B04'].href == f'{HREF}?sv=2021&sig=new'
+    assert len(signer) == 1
+
+
+def test_expired_disk_entry_is_a_miss(clock, tmp_path):
+    imgcol = make_imgcol()
+    SearchCache(ttl=60, cache_dir=tmp_path).put(imgcol, make_items())
+
+    clock.now += 61
+    assert SearchCache(ttl=60, cache_dir=tmp_path).get(imgcol) is None
+
+
+def test_unsigned_items_round_trip():
+    collection = unsign_items(make_items())
+
+    assert collection['features'][0]['assets']['B04']['href'] == HREF
+    assert json.loads(json.dumps(collection)) == collection # Sent as a task argument
+    assert sign_items(collection)[0].assets['B04'].href == f'{HREF}?sv=2021&sig=new'
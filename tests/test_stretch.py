@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from eo.stretch import band_histogram, histogram_percentiles, shared_percentiles, stretch_bands
+
+
+def quantile_stretch(band, lower, upper, gamma, nodata=0):
+    """The float quantile chain stretch_bands() replaced: quantiles without nodata, clip, gamma, uint8"""
+    values = band.astype(np.float32)
+    masked = np.where(values != nodata, values, np.nan)
+    low, high = np.nanquantile(masked, lower / 100.0), np.nanquantile(masked, upper / 100.0)
+    stretched = np.clip((values - low) / (high - low), 0, 1) ** (1 / gamma)
+
+    return (stretched * 255).astype(np.uint8), (low, high)
+
+
+@pytest.fixture
+def band():
+    band = np.random.default_rng(0).gamma(2, 800, (400, 400)).astype(np.uint16)
+    band[:40] = 0 # Nodata outside the scene's footprint
+    return band
+
+
+@pytest.mark.parametrize('gamma', [1.0, 2.2])
+@pytest.mark.parametrize('lower,upper', [(2, 98), (0.5, 99.5)])
+def test_stretch_matches_quantiles(band, lower, upper, gamma):
+    expected, (low, high) = quantile_stretch(band, lower, upper, gamma)
+
+    assert np.allclose(histogram_percentiles(band_histogram(band), lower, upper), (low, high), atol=1)
+    stretched = stretch_bands([band], lower, upper, gamma=gamma)
+    assert stretched.dtype == np.uint8
+    assert np.abs(stretched[0].astype(int) - expected).max() <= 1
+    assert (stretched[0][:40] == 0).all()
+
+
+def test_stretch_uint8_band():
+    band = np.random.default_rng(1).integers(1, 256, (50, 50)).astype(np.uint8)
+    expected, _ = quantile_stretch(band, 2, 98, 1.0)
+
+    assert np.abs(stretch_bands([band])[0].astype(int) - expected).max() <= 1
+
+
+def test_stretch_rejects_float_bands():
+    with pytest.raises(ValueError):
+        stretch_bands([np.ones((2, 2), dtype=np.float32)])
+
+
+def test_shared_percentiles_are_those_of_the_whole_series(band):
+    frames = [band[:200], band[200:]]
+
+    assert shared_percentiles([frames], 2, 98) == [histogram_percentiles(band_histogram(band), 2, 98)]
+    assert (stretch_bands(frames, percentiles=shared_percentiles([[frame] for frame in frames], 2, 98))
+            == stretch_bands(frames)).all()